@@ -0,0 +1,89 @@
+#!/usr/bin/python3
+# Stand-ins for the Firestore SDK so src/ modules can be imported and benchmarked
+# on a workstation, call install() before importing anything from src/
+import os
+import sys
+import time
+import types
+import threading
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+
+# Class standing in for firestore.GeoPoint
+class fakeGeoPoint:
+    def __init__(self, latitude, longitude):
+        self.latitude = latitude
+        self.longitude = longitude
+
+# Class standing in for a Firestore document reference, writes are counted by the client
+class fakeDocument:
+    def __init__(self, client, path):
+        self.client = client
+        self.path = path
+    def collection(self, name):
+        return fakeCollection(self.client, self.path + "/" + name)
+    def set(self, data, merge=False):
+        self.client.commit([(self.path, data)])
+
+# Class standing in for a Firestore collection reference
+class fakeCollection:
+    def __init__(self, client, path):
+        self.client = client
+        self.path = path
+    def document(self, name=None):
+        if name is None:
+            name = self.client.newId()
+        return fakeDocument(self.client, self.path + "/" + name)
+
+# Class standing in for a Firestore WriteBatch
+class fakeBatch:
+    def __init__(self, client):
+        self.client = client
+        self.writes = []
+    def set(self, document, data, merge=False):
+        self.writes.append((document.path, data))
+    def commit(self):
+        self.client.commit(self.writes)
+
+# Class standing in for a Firestore client
+#
+# Initilization takes the round trip time (seconds) of a single commit
+# Every set or batch commit sleeps for latency, documents are kept in docs
+class fakeClient:
+    def __init__(self, latency=0.05):
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.docs = {}
+        self.commits = 0
+        self.ids = 0
+    def newId(self):
+        with self.lock:
+            self.ids += 1
+            return "doc" + str(self.ids)
+    def collection(self, name):
+        return fakeCollection(self, name)
+    def batch(self):
+        return fakeBatch(self)
+    def commit(self, writes):
+        time.sleep(self.latency)
+        with self.lock:
+            self.commits += 1
+            for path, data in writes:
+                self.docs[path] = data
+
+# Adds src/ to the import path and registers fake firebase_admin modules
+def install():
+    if SRC not in sys.path:
+        sys.path.insert(0, SRC)
+    firebaseAdmin = types.ModuleType("firebase_admin")
+    firebaseAdmin._apps = {"fake": True}
+    credentials = types.ModuleType("firebase_admin.credentials")
+    credentials.Certificate = lambda path: path
+    firestore = types.ModuleType("firebase_admin.firestore")
+    firestore.GeoPoint = fakeGeoPoint
+    firestore.client = lambda: fakeClient()
+    firebaseAdmin.credentials = credentials
+    firebaseAdmin.firestore = firestore
+    sys.modules.setdefault("firebase_admin", firebaseAdmin)
+    sys.modules.setdefault("firebase_admin.credentials", credentials)
+    sys.modules.setdefault("firebase_admin.firestore", firestore)
@@ -0,0 +1,273 @@
+#!/usr/bin/python3
+# Micro-benchmarks of the sampling and parsing hot paths in sensors.py, ringBuffer.py and db.py
+#
+# Every benchmark is run at a realistic size (a ride on the device as configured) and a
+# stress size, and reports the time per call and samples per second (best of --repeat)
+# Results are saved to results/<commit>.json so a change can be compared with the run
+# of an earlier commit with --compare
+#
+# Usage: python3 microBench.py [--only getGPS,getIMU] [--sizes realistic,stress] [--repeat 5]
+#                              [--save] [--compare results/<commit>.json]
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import datetime
+import subprocess
+import statistics
+import numpy as np
+
+import fakes
+fakes.install()
+import db
+import sensors
+import orientation
+import ringBuffer
+import rideFormat
+import rideWriter
+
+RESULTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+
+# Returns n IMU sample dictionaries as sampleImu makes them (monotonic ns times), the last tenth rolled over
+def makeImuSamples(n, period=1.0):
+    rng = np.random.default_rng(1)
+    noise = np.round(rng.normal(0, 0.3, (n, 6)), 5)
+    samples = []
+    for i in range(n):
+        accelZ = -9.8 if i >= n - n // 10 else 9.8
+        samples.append({
+            'time': int(i * period * 1e9),
+            'accelX': noise[i, 0], 'accelY': noise[i, 1], 'accelZ': round(accelZ + noise[i, 2], 5),
+            'gyroX': noise[i, 3], 'gyroY': noise[i, 4], 'gyroZ': noise[i, 5],
+            'didRoll': False, 'rollover': False
+        })
+    return samples
+
+# Returns n GPS sample dictionaries as sampleGps makes them, every 50th without a fix
+def makeGpsSamples(n, period=15.0):
+    samples = []
+    for i in range(n):
+        if i % 50 == 49:
+            samples.append(None)
+            continue
+        samples.append({
+            'time': int(i * period * 1e9),
+            'lat': round(38.5382 + i * 1e-5, 5), 'long': round(-121.7617 - i * 1e-5, 5),
+            'speed': 12.3, 'alt': 15.0, 'sats': 8
+        })
+    return samples
+
+# Returns the header of a new ride file of kind (rideFormat.KIND_IMU or KIND_GPS) named fn
+def rideHeader(fn, kind):
+    if fn.endswith(rideFormat.EXTENSION):
+        return rideFormat.header(kind)
+    return sensors.IMU_HEADER if kind == rideFormat.KIND_IMU else sensors.GPS_HEADER
+
+# Writes n IMU (kind KIND_IMU) or GPS rows to fn, in the format of its extension
+def writeRide(fn, kind, n):
+    writer = rideWriter.rideWriter(fn, rideHeader(fn, kind), 256, 60.0, rideWriter.FSYNC_NEVER)
+    if kind == rideFormat.KIND_IMU:
+        for sample in makeImuSamples(n):
+            sensors.writeImuSample(writer, sample)
+    else:
+        imuSample = makeImuSamples(1)[0]
+        for sample in makeGpsSamples(n):
+            sensors.writeGpsSamples(sample, imuSample, writer)
+    writer.close()
+
+# Each benchmark is setup(n, path) -> run, where run() processes n samples
+# setup is not timed, run is called --repeat times
+
+def benchDetectRollover(n, path):
+    samples = makeImuSamples(n)
+    def run():
+        for sample in samples:
+            sensors.detectRollover(sample)
+    return run
+
+def benchDetectRolloverBatch(n, path):
+    accel = np.array([(s['accelX'], s['accelY'], s['accelZ']) for s in makeImuSamples(n)])
+    return lambda: sensors.detectRolloverBatch(accel)
+
+def benchOrientation(n, path):
+    rows = [(i / 50.0, s['accelX'], s['accelY'], s['accelZ'], s['gyroX'], s['gyroY'], s['gyroZ'])
+            for i, s in enumerate(makeImuSamples(n))]
+    def run():
+        estimator = orientation.orientationFilter(sensors.ORIENTATION_TAU)
+        for row in rows:
+            estimator.update(*row)
+            sensors.CONE.contains(*estimator.gravity())
+    return run
+
+def benchAppend(n, path):
+    samples = makeImuSamples(n)
+    def run():
+        buffer = ringBuffer.cyclicalArray(sensors.IMU_SAMPLE_SIZE)
+        for sample in samples:
+            buffer.append(sample)
+    return run
+
+# Writes with writeAll(writer) to a new file, with the device's writer settings, on every run
+def writerBench(path, ext, kind, writeAll):
+    fn = os.path.join(path, "write" + ext)
+    def run():
+        if os.path.exists(fn):
+            os.remove(fn)
+        writer = rideWriter.rideWriter(fn, rideHeader(fn, kind), sensors.WRITER_ROWS, sensors.WRITER_DELAY,
+                                       sensors.WRITER_FSYNC)
+        writeAll(writer)
+        writer.close()
+    return run
+
+def benchWriteImu(ext):
+    def setup(n, path):
+        samples = makeImuSamples(n)
+        def writeAll(writer):
+            for sample in samples:
+                sensors.writeImuSample(writer, sample)
+        return writerBench(path, ext, rideFormat.KIND_IMU, writeAll)
+    return setup
+
+def benchWriteGps(ext):
+    def setup(n, path):
+        samples = makeGpsSamples(n)
+        imuSample = makeImuSamples(1)[0]
+        def writeAll(writer):
+            for sample in samples:
+                sensors.writeGpsSamples(sample, imuSample, writer)
+        return writerBench(path, ext, rideFormat.KIND_GPS, writeAll)
+    return setup
+
+def benchGetGps(ext):
+    def setup(n, path):
+        fn = os.path.join(path, f"ride{n}{ext}")
+        writeRide(fn, rideFormat.KIND_GPS, n)
+        return lambda: db.getGPS(fn)
+    return setup
+
+def benchGetImu(ext):
+    def setup(n, path):
+        fn = os.path.join(path, f"ride{n}_imu{ext}")
+        writeRide(fn, rideFormat.KIND_IMU, n)
+        return lambda: db.getIMU(fn)
+    return setup
+
+# getIMU of a file cut off by power loss, ending in null characters
+def benchGetImuDirty(n, path):
+    fn = os.path.join(path, f"dirty{n}_imu.csv")
+    writeRide(fn, rideFormat.KIND_IMU, n)
+    with open(fn, "a") as f:
+        f.write("\x00" * 512)
+    return lambda: db.getIMU(fn)
+
+# (name, setup, realistic size, stress size)
+# Realistic sizes are an hour of riding: 1 Hz IMU samples, a GPS sample every 15 seconds
+# and the rollover window, stress sizes a long research ride at the crash capture rate
+BENCHMARKS = [
+    ("detectRollover", benchDetectRollover, 3600, 360000),
+    ("detectRolloverBatch", benchDetectRolloverBatch, 3600, 360000),
+    ("orientationFilter", benchOrientation, 3600, 360000),
+    ("cyclicalArray.append", benchAppend, 3600, 360000),
+    ("writeImuSample.csv", benchWriteImu(".csv"), 3600, 360000),
+    ("writeImuSample.bin", benchWriteImu(rideFormat.EXTENSION), 3600, 360000),
+    ("writeGpsSamples.csv", benchWriteGps(".csv"), 240, 100000),
+    ("writeGpsSamples.bin", benchWriteGps(rideFormat.EXTENSION), 240, 100000),
+    ("getGPS.csv", benchGetGps(".csv"), 240, 100000),
+    ("getGPS.bin", benchGetGps(rideFormat.EXTENSION), 240, 100000),
+    ("getIMU.csv", benchGetImu(".csv"), 3600, 360000),
+    ("getIMU.bin", benchGetImu(rideFormat.EXTENSION), 3600, 360000),
+    ("getIMU.dirty", benchGetImuDirty, 3600, 360000),
+]
+
+# Runs one benchmark
+#
+# Returns a dictionary of the sample count, best and median seconds per run,
+# microseconds per sample and samples per second (of the best run)
+def measure(setup, n, repeat, path):
+    run = setup(n, path)
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+    best = min(times)
+    return {
+        "samples": n,
+        "best": best,
+        "median": statistics.median(times),
+        "usPerSample": best / n * 1e6,
+        "samplesPerSec": n / best if best > 0 else float("inf")
+    }
+
+# Returns the current commit (with + if the tree has changes) or "unknown" outside a git checkout
+def gitCommit():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                cwd=fakes.SRC, check=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], capture_output=True,
+                               text=True, cwd=fakes.SRC, check=True).stdout.strip()
+        return commit + ("+" if dirty else "")
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+def main():
+    parser = argparse.ArgumentParser(description="Micro-benchmarks of the sampling and parsing hot paths")
+    parser.add_argument('--only', help="comma separated benchmark names (or name prefixes) to run")
+    parser.add_argument('--sizes', default="realistic,stress", help="comma separated sizes to run (realistic, stress)")
+    parser.add_argument('--repeat', type=int, default=5, help="runs of each benchmark, the best is reported")
+    parser.add_argument('--save', action='store_true', help="save results to results/<commit>.json")
+    parser.add_argument('--compare', help="results file of an earlier run to compare with")
+    args = parser.parse_args()
+
+    only = args.only.split(",") if args.only else None
+    sizes = args.sizes.split(",")
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+
+    commit = gitCommit()
+    print(f"commit {commit}, python {platform.python_version()}, {platform.machine()}, best of {args.repeat}")
+    header = f"{'benchmark':<22} {'size':>9} {'samples':>8} {'us/sample':>10} {'samples/s':>12}"
+    print(header + (f" {'vs base':>8}" if baseline else ""))
+
+    results = {}
+    path = tempfile.mkdtemp(prefix="microBench")
+    try:
+        for name, setup, realistic, stress in BENCHMARKS:
+            if only and not any(name.startswith(prefix) for prefix in only):
+                continue
+            for size, n in (("realistic", realistic), ("stress", stress)):
+                if size not in sizes:
+                    continue
+                key = f"{name}/{size}"
+                results[key] = result = measure(setup, n, args.repeat, path)
+                line = f"{name:<22} {size:>9} {n:>8} {result['usPerSample']:>10.3f} {result['samplesPerSec']:>12.0f}"
+                if key in baseline:
+                    # Above 1 is slower than the baseline
+                    line += f" {result['usPerSample'] / baseline[key]['usPerSample']:>7.2f}x"
+                print(line)
+                sys.stdout.flush()
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+
+    if args.save:
+        os.makedirs(RESULTS, exist_ok=True)
+        fn = os.path.join(RESULTS, commit + ".json")
+        with open(fn, "w") as f:
+            json.dump({
+                "commit": commit,
+                "date": str(datetime.datetime.now()),
+                "python": platform.python_version(),
+                "machine": platform.machine(),
+                "repeat": args.repeat,
+                "results": results
+            }, f, indent=2)
+        print(f"Saved to {fn}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+#!/usr/bin/python3
+# Measures time to delivery of emergency messages through rockBlock.py against rbEmulator
+#
+# cold opens a new rockBlock for every message (configuring the port and waiting for
+# network time and signal each time), session sends on an rbSession whose state was
+# refreshed while idle, as the satTransmitter does
+# Failed attempts are retried with the same backoff as the device, scaled by --delay-scale
+#
+# Usage: python3 rbBench.py [--sends N] [--profiles strong,good] [--modes cold,session]
+#                           [--command-latency SECONDS] [--session-latency SECONDS] [--fail-rate P] [--drop-rate P]
+import sys
+import time
+import argparse
+import datetime
+import statistics
+
+import fakes
+sys.path.insert(0, fakes.SRC)
+import rockBlock
+import rbSession
+import retry
+import sbdMessage
+import rbEmulator
+
+# Returns the value at fraction q of sorted values
+def percentile(values, q):
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+# Sends one message on a new rockBlock object, as moMessage did before rbSession
+def sendCold(port, content):
+    rb = rockBlock.rockBlock(port, rockBlock.rockBlockProtocol())
+    try:
+        sent = rb.sendMessage(content)
+    finally:
+        rb.close()
+    if not sent:
+        raise rockBlock.rockBlockException("Message not sent")
+
+# Sends one message on session
+def sendSession(session, content):
+    if not session.send(content, rockBlock.rockBlockProtocol()):
+        raise rockBlock.rockBlockException("Message not sent")
+
+# Runs sends messages in mode against an emulator with the given settings
+#
+# Returns (list of seconds to delivery of delivered messages, number of messages given up on, attempts)
+def run(mode, sends, policy, **emulatorArgs):
+    emulator = rbEmulator.rbEmulator(**emulatorArgs).start()
+    session = rbSession.rbSession(emulator.port, refreshSecs=0)
+    content = sbdMessage.encode("15305550100", "bench", {'lat': 38.5382, 'long': -121.7617,
+                                'time': datetime.datetime.now()}, True)
+    times, failed = [], 0
+    attempts = policy.attempts
+    try:
+        for _ in range(sends):
+            if mode == "session":
+                # Idle time refresh, not part of the delivery time
+                try:
+                    session.refresh()
+                except Exception:
+                    pass
+                send = lambda: sendSession(session, content)
+            else:
+                send = lambda: sendCold(emulator.port, content)
+            start = time.perf_counter()
+            try:
+                policy.call(send)
+                times.append(time.perf_counter() - start)
+            except Exception:
+                failed += 1
+    finally:
+        session.close()
+        emulator.stop()
+    return times, failed, policy.attempts - attempts
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark RockBLOCK send latency against an emulated modem")
+    parser.add_argument('--sends', type=int, default=10, help="messages sent per profile and mode")
+    parser.add_argument('--profiles', default="strong,good", help="comma separated rbEmulator signal profiles")
+    parser.add_argument('--modes', default="cold,session", help="comma separated modes (cold, session)")
+    parser.add_argument('--command-latency', type=float, default=0.05, help="seconds per plain AT command")
+    parser.add_argument('--session-latency', type=float, default=1.0, help="mean seconds per +SBDIX session")
+    parser.add_argument('--fail-rate', type=float, default=0.0, help="chance a session fails")
+    parser.add_argument('--drop-rate', type=float, default=0.0, help="chance a command is not answered")
+    parser.add_argument('--delay-scale', type=float, default=0.1, help="scale of the device's retry delays")
+    args = parser.parse_args()
+
+    print(f"{args.sends} sends, {args.command_latency}s commands, {args.session_latency}s sessions, fail rate {args.fail_rate}, drop rate {args.drop_rate}")
+    print(f"{'profile':>12} {'mode':>8} {'sent':>6} {'tries':>6} {'min':>7} {'p50':>7} {'p90':>7} {'max':>7} {'mean':>7}")
+    for profile in args.profiles.split(","):
+        for mode in args.modes.split(","):
+            # The device's emergency message policy (sensors.RB_RETRY) with scaled delays
+            policy = retry.retryPolicy("bench", maxAttempts=10, baseDelay=5.0 * args.delay_scale,
+                                       maxDelay=120.0 * args.delay_scale)
+            times, failed, attempts = run(mode, args.sends, policy, profile=profile,
+                                          commandLatency=args.command_latency,
+                                          sessionLatency=args.session_latency, sessionJitter=args.session_latency / 4,
+                                          failRate=args.fail_rate, dropRate=args.drop_rate, seed=1)
+            times.sort()
+            if times:
+                print(f"{profile:>12} {mode:>8} {len(times):>6} {attempts:>6} {times[0]:7.2f} {percentile(times, 0.5):7.2f} "
+                      f"{percentile(times, 0.9):7.2f} {times[-1]:7.2f} {statistics.mean(times):7.2f}")
+            else:
+                print(f"{profile:>12} {mode:>8} {0:>6} {attempts:>6} {'-':>7} {'-':>7} {'-':>7} {'-':>7} {'-':>7}")
+
+if __name__ == "__main__":
+    main()
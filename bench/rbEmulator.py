@@ -0,0 +1,216 @@
+#!/usr/bin/python3
+# RockBLOCK (Iridium 9603) emulator on a pseudo-terminal, so rockBlock.py can be run
+# and timed without the modem or satellite coverage
+#
+# Implements the AT commands rockBlock.py uses: AT, ATE1, AT&K0, AT+SBDMTA, AT+CSQ,
+# AT-MSSTM, AT+SBDWB, AT+SBDIX, AT+SBDD0 and AT+SBDRB, anything else answers ERROR
+#
+# Usage: python3 rbEmulator.py [--profile strong] [--session-latency 6] [--fail-rate 0.1]
+# prints the pty path to pass to rockBlock.rockBlock and runs until interrupted
+import os
+import tty
+import time
+import random
+import select
+import argparse
+import threading
+
+# Signal strength (0-5 bars) over time, called with the seconds since the emulator started
+# and the emulator's random.Random, so a seeded emulator sees the same signal every run
+SIGNAL_PROFILES = {
+    "strong": lambda t, rng: 5,
+    "good": lambda t, rng: rng.choice((3, 4, 5)),
+    "weak": lambda t, rng: rng.choice((1, 2, 2, 3)),
+    # 20 seconds of coverage then 10 without, like driving between hills
+    "intermittent": lambda t, rng: 4 if t % 30 < 20 else 0,
+    "none": lambda t, rng: 0
+}
+
+# MO status codes +SBDIX reports for a failed session
+MO_FAILURES = (13, 18, 32, 35)
+
+# Class emulating a RockBLOCK on a pty
+#
+# Initilization takes the signal profile (a SIGNAL_PROFILES name or function of (t, rng)) and
+# the emulated timings: commandLatency (seconds for a plain AT command) and
+# sessionLatency with sessionJitter (seconds for an +SBDIX session)
+# failRate is the chance a session fails with signal, dropRate the chance a command
+# is never answered (the client times out), checksumFailRate the chance +SBDWB
+# reports a checksum error
+# mtMessages is a list of bytes delivered to the client by later sessions
+# Start it with start, connect the client to port, sent holds every delivered MO message
+class rbEmulator:
+    def __init__(self, profile="strong", commandLatency=0.005, sessionLatency=6.0, sessionJitter=2.0,
+                 failRate=0.0, dropRate=0.0, checksumFailRate=0.0, mtMessages=None, seed=None):
+        self.profile = SIGNAL_PROFILES[profile] if isinstance(profile, str) else profile
+        self.commandLatency = commandLatency
+        self.sessionLatency = sessionLatency
+        self.sessionJitter = sessionJitter
+        self.failRate = failRate
+        self.dropRate = dropRate
+        self.checksumFailRate = checksumFailRate
+        self.mtMessages = list(mtMessages or [])
+        self.random = random.Random(seed)
+        self.echo = True
+        self.moBuffer = b""
+        self.mtBuffer = b""
+        self.momsn = 0
+        self.mtmsn = 0
+        self.sent = []
+        self.commands = {}
+        self.started = time.monotonic()
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="rbEmulator", daemon=True)
+
+    def start(self):
+        self.started = time.monotonic()
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        os.close(self.master)
+        os.close(self.slave)
+
+    # Returns the current signal strength from the profile
+    def signal(self):
+        return self.profile(time.monotonic() - self.started, self.random)
+
+    def write(self, *lines):
+        os.write(self.master, b"".join(line.encode() + b"\r\n" for line in lines))
+
+    # Reads up to size bytes, waiting at most timeout seconds for the first
+    def read(self, size, timeout=0.2):
+        ready, _, _ = select.select([self.master], [], [], timeout)
+        if not ready:
+            return b""
+        try:
+            return os.read(self.master, size)
+        except OSError:
+            return b""
+
+    # Reads exactly size bytes of binary data, or fewer if the client stops sending
+    def readExactly(self, size, timeout=60.0):
+        data = b""
+        deadline = time.monotonic() + timeout
+        while len(data) < size and time.monotonic() < deadline and not self.stopped.is_set():
+            data += self.read(size - len(data))
+        return data
+
+    def run(self):
+        line = b""
+        while not self.stopped.is_set():
+            data = self.read(256)
+            for byte in data:
+                if byte == 0x0D:
+                    self.handle(line.decode(errors="replace").strip())
+                    line = b""
+                elif byte != 0x0A:
+                    line += bytes([byte])
+
+    # Answers one command
+    def handle(self, command):
+        if not command:
+            return
+        name = command.split("=")[0].upper()
+        self.commands[name] = self.commands.get(name, 0) + 1
+        time.sleep(self.commandLatency)
+        if self.random.random() < self.dropRate:
+            return
+        echo = [command] if self.echo else []
+
+        if name in ("AT", "AT&K0", "AT&W0", "AT&Y0", "AT*F", "AT+SBDMTA"):
+            self.write(*echo, "OK")
+        elif name in ("ATE1", "ATE0"):
+            self.echo = name == "ATE1"
+            self.write(*([command] if self.echo else []), "OK")
+        elif name == "AT+CSQ":
+            self.write(*echo, f"+CSQ:{self.signal()}", "", "OK")
+        elif name == "AT-MSSTM":
+            if self.signal() > 0:
+                # Iridium time counts 90ms frames since the Iridium epoch
+                frames = int((time.time() * 1000 - 1399818235000) / 90)
+                self.write(*echo, f"-MSSTM: {frames & 0xFFFFFFFF:08x}", "", "OK")
+            else:
+                self.write(*echo, "-MSSTM: no network service", "", "OK")
+        elif name == "AT+SBDWB":
+            self.writeBinary(command, echo)
+        elif name == "AT+SBDIX":
+            self.session(echo)
+        elif name == "AT+SBDD0":
+            self.moBuffer = b""
+            self.write(*echo, "0", "", "OK")
+        elif name == "AT+SBDRB":
+            checksum = sum(self.mtBuffer) & 0xFFFF
+            os.write(self.master, command.encode() + b"\r" + len(self.mtBuffer).to_bytes(2, "big") +
+                     self.mtBuffer + checksum.to_bytes(2, "big") + b"\r\n")
+            self.write("OK")
+        else:
+            self.write(*echo, "ERROR")
+
+    # AT+SBDWB=<length>, reads the message and its 2 byte checksum into the MO buffer
+    def writeBinary(self, command, echo):
+        try:
+            length = int(command.split("=")[1])
+        except (IndexError, ValueError):
+            self.write(*echo, "ERROR")
+            return
+        if length < 1 or length > 340:
+            self.write(*echo, "3")
+            return
+        self.write(*echo, "READY")
+        data = self.readExactly(length + 2)
+        if len(data) < length + 2:
+            # Timed out waiting for the message
+            self.write("", "1", "", "OK")
+            return
+        message, checksum = data[:length], int.from_bytes(data[length:], "big")
+        if checksum != sum(message) & 0xFFFF or self.random.random() < self.checksumFailRate:
+            self.write("", "2", "", "OK")
+            return
+        self.moBuffer = message
+        self.write("", "0", "", "OK")
+
+    # AT+SBDIX, sends the MO buffer and collects the next MT message
+    def session(self, echo):
+        signal = self.signal()
+        time.sleep(max(0.0, self.random.gauss(self.sessionLatency, self.sessionJitter)))
+        mtStatus, mtLength = 0, 0
+        if signal == 0 or self.random.random() < self.failRate:
+            moStatus = self.random.choice(MO_FAILURES)
+        else:
+            moStatus = 0
+            if self.moBuffer:
+                self.momsn += 1
+                self.sent.append((time.monotonic(), self.moBuffer))
+            if self.mtMessages:
+                self.mtBuffer = self.mtMessages.pop(0)
+                self.mtmsn += 1
+                mtStatus, mtLength = 1, len(self.mtBuffer)
+        self.write(*echo, f"+SBDIX: {moStatus}, {self.momsn}, {mtStatus}, {self.mtmsn}, {mtLength}, "
+                          f"{len(self.mtMessages)}", "", "OK")
+
+def main():
+    parser = argparse.ArgumentParser(description="Emulate a RockBLOCK on a pseudo-terminal")
+    parser.add_argument('--profile', default="strong", choices=sorted(SIGNAL_PROFILES), help="signal profile")
+    parser.add_argument('--session-latency', type=float, default=6.0, help="mean seconds per +SBDIX session")
+    parser.add_argument('--fail-rate', type=float, default=0.0, help="chance a session fails")
+    parser.add_argument('--drop-rate', type=float, default=0.0, help="chance a command is not answered")
+    args = parser.parse_args()
+
+    emulator = rbEmulator(args.profile, sessionLatency=args.session_latency, failRate=args.fail_rate,
+                          dropRate=args.drop_rate).start()
+    print(f"RockBLOCK emulator on {emulator.port}")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        print(f"{len(emulator.sent)} messages delivered, commands: {emulator.commands}")
+        emulator.stop()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+#!/usr/bin/python3
+# Measures upload throughput of db.uploadRides against a local fake Firestore client
+#
+# Usage: python3 uploadBench.py [--rides N] [--rows N] [--latency SECONDS] [--workers 1,2,4,8]
+import os
+import time
+import shutil
+import argparse
+import tempfile
+import datetime
+
+import fakes
+fakes.install()
+import db
+
+GPS_HEADER = 'time,lat,long,vel,alt,sats,accelX,accelY,accelZ,possibleRoll,rollover\n'
+IMU_HEADER = 'time,accelX,accelY,accelZ,gyroX,gyroY,gyroZ,possibleRoll,rollover\n'
+
+# Writes rides GPS files (and an IMU file for every fourth ride) of rows rows to path
+#
+# Returns a list of the written file paths
+def makeRides(path, rides, rows):
+    start = datetime.datetime(2020, 6, 1, 8, 0, 0, 1)
+    filenames = []
+    for ride in range(rides):
+        fn = os.path.join(path, f"ride{ride}.csv")
+        with open(fn, "w") as f:
+            f.write(GPS_HEADER)
+            for row in range(rows):
+                f.write(f"{start + datetime.timedelta(seconds=15 * row)},38.53{row % 100:02d},-121.76{row % 100:02d},"
+                        f"12.3,15.0,8,0.1,0.2,9.8,False,False\n")
+        filenames.append(fn)
+        if ride % 4 == 0:
+            fn = os.path.join(path, f"ride{ride}_imu.csv")
+            with open(fn, "w") as f:
+                f.write(IMU_HEADER)
+                for row in range(60):
+                    f.write(f"{start + datetime.timedelta(seconds=row)},0.1,0.2,-9.8,0.01,0.02,0.03,True,{row == 59}\n")
+            filenames.append(fn)
+    return filenames
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark db.uploadRides against a fake Firestore client")
+    parser.add_argument('--rides', type=int, default=200, help="number of rides to upload")
+    parser.add_argument('--rows', type=int, default=240, help="GPS rows per ride")
+    parser.add_argument('--latency', type=float, default=0.2, help="seconds per commit round trip")
+    parser.add_argument('--workers', default="1,2,4,8", help="comma separated worker counts to test")
+    args = parser.parse_args()
+
+    path = tempfile.mkdtemp()
+    try:
+        filenames = makeRides(path, args.rides, args.rows)
+        print(f"{args.rides} rides ({len(filenames)} files), {args.rows} rows each, {args.latency}s per commit")
+        for workers in [int(w) for w in args.workers.split(",")]:
+            # Fresh upload manifests so every run uploads every ride
+            db.MANIFESTS = tempfile.mkdtemp(dir=path)
+            client = fakes.fakeClient(args.latency)
+            start = time.perf_counter()
+            results = db.uploadRides(filenames, workers, client)
+            elapsed = time.perf_counter() - start
+            sent = sum(results.values())
+            print(f"workers {workers:3d}: {elapsed:8.2f}s  {args.rides / elapsed:8.1f} rides/s  "
+                  f"{sent}/{len(filenames)} files committed in {client.commits} commits")
+    finally:
+        shutil.rmtree(path)
+
+if __name__ == "__main__":
+    main()
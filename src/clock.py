@@ -0,0 +1,167 @@
+#!/usr/bin/python3
+# Clocks the sampling loop runs on
+#
+# Every thread of the loop reads the time and sleeps through a clock object:
+# monotonic() (seconds), monotonicNs() (integer nanoseconds, sample timestamps),
+# now() (local datetime), timeNs() (unix nanoseconds of the wall clock) and
+# wait(event, timeout), which returns True once event is set or False after timeout seconds
+# REAL is the system clock, virtualClock runs recorded rides faster than real time
+# wallAnchor converts monotonic sample timestamps to UTC
+import math
+import time
+import datetime
+import threading
+
+# Real seconds between checks of a waiting thread's event
+POLL_SECS = 0.005
+# Real seconds without progress after which a virtualClock advances anyway,
+# for when a thread of the loop is blocked on something other than the clock
+STALL_SECS = 0.5
+# Nanoseconds in a second
+NS = 1000000000
+
+EPOCH = datetime.datetime(1970, 1, 1)
+MICROSECOND = datetime.timedelta(microseconds=1)
+
+class realClock:
+    def monotonic(self):
+        return time.monotonic()
+
+    def monotonicNs(self):
+        return time.monotonic_ns()
+
+    def now(self):
+        return datetime.datetime.now()
+
+    def timeNs(self):
+        return time.time_ns()
+
+    def wait(self, event, timeout):
+        if event is None:
+            time.sleep(timeout)
+            return False
+        return event.wait(timeout)
+
+REAL = realClock()
+
+# Clock whose time only moves when the threads using it wait
+#
+# Initilization takes the datetime virtual time starts at and the speed, a multiple
+# of real time (1 for real time), or None to run as fast as possible
+# A thread joins the clock with join or the first time it waits, time advances to
+# the earliest wake up once every joined (and still running) thread is waiting, so
+# a slow consumer delays the recording rather than missing samples
+# hold stops time until a matching release, for threads that haven't joined yet
+# At a fixed speed time also never runs ahead of real time * speed
+class virtualClock:
+    def __init__(self, start, speed=None):
+        self.start = start
+        self.speed = speed
+        self.t = 0.0
+        self.cond = threading.Condition()
+        self.participants = set()
+        self.waiting = {}
+        self.holds = 0
+        self.realStart = None
+        self.lastAdvance = None
+
+    def monotonic(self):
+        return self.t
+
+    def monotonicNs(self):
+        return int(self.t * NS)
+
+    def now(self):
+        return self.start + datetime.timedelta(seconds=self.t)
+
+    # The start is taken to be UTC
+    def timeNs(self):
+        return (self.start - EPOCH) // MICROSECOND * 1000 + self.monotonicNs()
+
+    def join(self):
+        with self.cond:
+            self.participants.add(threading.current_thread())
+
+    def hold(self):
+        with self.cond:
+            self.holds += 1
+
+    def release(self):
+        with self.cond:
+            self.holds -= 1
+            self.cond.notify_all()
+
+    def wait(self, event, timeout):
+        me = threading.current_thread()
+        with self.cond:
+            if self.realStart is None:
+                self.realStart = self.lastAdvance = time.monotonic()
+            self.participants.add(me)
+            self.waiting[me] = math.inf if timeout is None else self.t + timeout
+            try:
+                while True:
+                    if event is not None and event.is_set():
+                        return True
+                    if self.t >= self.waiting[me]:
+                        return False
+                    self.advance()
+                    if self.t < self.waiting[me]:
+                        self.cond.wait(POLL_SECS)
+            finally:
+                del self.waiting[me]
+
+    # Moves time to the earliest wake up if nothing else can happen before it
+    # Called with cond held
+    def advance(self):
+        if self.holds > 0:
+            return
+        now = time.monotonic()
+        self.participants = {thread for thread in self.participants if thread.is_alive()}
+        allWaiting = all(thread in self.waiting for thread in self.participants)
+        if not allWaiting and now - self.lastAdvance < STALL_SECS:
+            return
+        target = min(self.waiting.values())
+        if self.speed is not None:
+            target = min(target, (now - self.realStart) * self.speed)
+        if target > self.t:
+            self.t = target
+            self.lastAdvance = now
+            self.cond.notify_all()
+
+# Maps monotonic nanosecond timestamps to UTC for one ride
+#
+# Initilization takes the clock, the anchor starts from the clock's wall time, which
+# may be far off on a pi that booted without network (no RTC or NTP)
+# offset is added to a monotonic timestamp to get unix nanoseconds, samples are only
+# stamped with monotonicNs and converted with the offset when written as text or read
+# correct re-anchors to GPS time, once per ride, if the two disagree by more than a tolerance
+class wallAnchor:
+    def __init__(self, clock=REAL):
+        self.clock = clock
+        self.offset = clock.timeNs() - clock.monotonicNs()
+        self.fromGps = False
+
+    # Returns the unix time (seconds) of the monotonic timestamp ns
+    def toUnix(self, ns):
+        return (ns + self.offset) / NS
+
+    # Returns the naive UTC datetime of the monotonic timestamp ns
+    def toDatetime(self, ns):
+        return EPOCH + (ns + self.offset) // 1000 * MICROSECOND
+
+    # Checks the anchor against a GPS time, only the first call of a ride has any effect
+    #
+    # @utc: naive UTC datetime reported by the GPS
+    # @ns: monotonic timestamp the GPS sentence was received at
+    # @tolerance: seconds the wall clock may be off by before it is replaced by GPS time
+    #
+    # Returns the number of seconds the anchor moved by (0 if it was kept)
+    def correct(self, utc, ns, tolerance):
+        if self.fromGps:
+            return 0.0
+        self.fromGps = True
+        offset = (utc - EPOCH) // MICROSECOND * 1000 - ns
+        if abs(offset - self.offset) <= tolerance * NS:
+            return 0.0
+        moved, self.offset = (offset - self.offset) / NS, offset
+        return moved
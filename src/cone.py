@@ -0,0 +1,36 @@
+#!/usr/bin/python3
+import numpy as np
+
+# Class representing the "critical value cone" used to detect a rollover
+# x^2+y^2=((minAccel/(maxAccel-minAccel))*(z-minAccel)*sensitivity)^2
+#
+# Initilization takes the cone's minimum and maximum z acceleration and sensitivity
+# The cone's coefficients are computed once, so checking a sample is a few
+# multiplications and no square roots (squared distances are compared)
+# Check a single sample with contains, or an array of samples with mask
+class rolloverCone:
+    def __init__(self, minAccel, maxAccel, sensitivity):
+        self.minAccel = minAccel
+        self.maxAccel = maxAccel
+        self.sensitivity = sensitivity
+        # Radius of the cone at height z is scale*(z-minAccel)
+        self.scale = (minAccel / (maxAccel - minAccel)) * sensitivity
+
+    # Returns True if the acceleration (x, y, z) is inside the cone
+    def contains(self, x, y, z):
+        # MIN_ACCEL <= z <= MAX_ACCEL
+        if z < self.minAccel or z > self.maxAccel:
+            return False
+        r = self.scale * (z - self.minAccel)
+        return x * x + y * y <= r * r
+
+    # Checks every row of accel against the cone
+    #
+    # @accel: array of shape (n, 3) holding (accelX, accelY, accelZ) rows
+    #
+    # Returns a boolean array of length n, True where the sample is inside the cone
+    def mask(self, accel):
+        accel = np.asarray(accel, dtype=np.float64)
+        x, y, z = accel[:, 0], accel[:, 1], accel[:, 2]
+        r = self.scale * (z - self.minAccel)
+        return (z >= self.minAccel) & (z <= self.maxAccel) & (x * x + y * y <= r * r)
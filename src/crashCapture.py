@@ -0,0 +1,68 @@
+#!/usr/bin/python3
+import math
+import threading
+import ringBuffer
+
+# Class that keeps the last few seconds of high rate IMU samples and freezes them around a trigger
+#
+# Initilization takes the sample rate (hz), the seconds kept before and after a trigger
+# and a function save(window) that writes a capture out
+# The sampling thread adds every sample (a tuple in ringBuffer.IMU_DTYPE field order)
+# with add, any thread can call trigger
+# After a trigger postSecs more seconds are recorded, then the preSecs + postSecs
+# window is copied out of the ring and saved on its own thread, so the sampling
+# thread never waits on the SD card
+# The sample the trigger arrived on is marked as the rollover
+# Triggers while a capture is being recorded are ignored
+class crashCapture:
+    def __init__(self, rate, preSecs, postSecs, save):
+        self.period = 1.0 / rate
+        self.preSamples = math.ceil(preSecs * rate)
+        self.postSamples = math.ceil(postSecs * rate)
+        self.ring = ringBuffer.cyclicalArray(self.preSamples + self.postSamples)
+        self.save = save
+        self.triggered = False
+        self.remaining = None
+        self.captures = 0
+        self.savers = []
+
+    # Adds a sample to the ring, called from the sampling thread only
+    #
+    # @row: tuple of (time, accelX, accelY, accelZ, gyroX, gyroY, gyroZ, didRoll, rollover)
+    def add(self, row):
+        if self.triggered and self.remaining is None:
+            self.triggered = False
+            self.remaining = self.postSamples
+            row = row[:-1] + (True,)
+        self.ring.appendRow(row)
+
+        if self.remaining is not None:
+            self.remaining -= 1
+            if self.remaining <= 0:
+                self.freeze()
+
+    # Starts a capture around the next sample, returns False if one is already being recorded
+    def trigger(self):
+        if self.triggered or self.remaining is not None:
+            return False
+        self.triggered = True
+        return True
+
+    # Returns True while a capture is waiting for its post trigger samples
+    def recording(self):
+        return self.triggered or self.remaining is not None
+
+    # Copies the window out of the ring and saves it in the background
+    def freeze(self):
+        window = self.ring.window().copy()
+        self.remaining = None
+        self.captures += 1
+        saver = threading.Thread(target=self.save, args=(window,), name="crashCaptureSave", daemon=True)
+        saver.start()
+        self.savers = [thread for thread in self.savers if thread.is_alive()] + [saver]
+
+    # Waits for captures that are still being saved
+    def join(self):
+        for saver in self.savers:
+            saver.join()
+        self.savers = []
@@ -3,15 +3,22 @@ import re
 import os
 import os.path
 import csv
-import time
+import array
+import threading
+import concurrent.futures
 import traceback
 import datetime
 import firebase_admin
 from firebase_admin import credentials, firestore
 from xml.dom import minidom
+import settings
+import rideFormat
+import uploadManifest
+import retry
 
 UNSENT_RIDES = "/home/pi/kadd-pi/data/rides/unsent/"
 SENT_RIDES = "/home/pi/kadd-pi/data/rides/sent/"
+MANIFESTS = "/home/pi/kadd-pi/data/rides/manifests/"
 CERT = "/home/pi/kadd-pi/src/agCert.json"
 ERR_LOG = "/home/pi/kadd-pi/data/errorLog.txt"
 CONFIG = "/home/pi/kadd-pi/data/about.xml"
@@ -21,12 +28,25 @@ if os.path.isfile(CONFIG):
     config = minidom.parse(CONFIG)
     USER_NAME = str(config.getElementsByTagName('uid')[0].firstChild.data)
     DEVICE_NAME = str(config.getElementsByTagName('devId')[0].firstChild.data)
+    UPLOAD_WORKERS = settings.configValue(config, 'uploadWorkers', 4)
+    PAGE_ROWS = settings.configValue(config, 'uploadPageRows', 1000)
 else:
     USER_NAME = "default_user"
     DEVICE_NAME = "default_device"
+    # Number of rides uploaded at once
+    UPLOAD_WORKERS = 4
+    # Number of rows in each page document of an uploaded ride
+    PAGE_ROWS = 1000
 # For testing purposes
 RIDE_NAME = "ride"
 
+# Number of pages committed together in one WriteBatch
+PAGES_PER_BATCH = 4
+
+# Firestore client shared by every upload, created by getClient
+client = None
+clientLock = threading.Lock()
+
 # Class containing all accelerometer data at a specific point
 # collected as part of compatibility with iOS application's usage of database
 class TerrainPoint:
@@ -46,211 +66,299 @@ class TerrainPoint:
         return(u'TerrainPoint(x={}, y={}, z={}, didRollover={})'\
                .format(self.x,self.y,self.z,self.didRollover))
 
-# Performs transmission of data to the database, retry if no connection
+# Returns True if a database error is worth retrying
+# Firestore reports rejected requests (bad data, permissions, ...) with a 4xx code,
+# those fail the same way every time, timeouts and rate limiting are retried
 #
-# @db: firebase database object
-# @data: information to send
-# @dest: destination collection
-# @docName: destination document name
-def sendToDB(db, data, dest, docName):
-    try:
-        # Attempt to send data to db
-        result = db.collection(dest)\
-        .document(docName)\
-        .set(data, merge=True)
+# @exc: exception raised while writing to Firestore
+def isRetryableDbError(exc):
+    code = getattr(exc, 'code', None)
+    if isinstance(code, int) and 400 <= code < 500 and code not in (408, 429):
+        return False
+    return retry.isRetryable(exc)
 
-        return result
-    except Exception as exc:
-        # Connection could not be established or was interrupted
-        with open(ERR_LOG, "a") as errorLog:
-            errorLog.write(str(datetime.datetime.now())+"\n")
-            traceback.print_tb(exc.__traceback__, file=errorLog)
-        print("Exception occured sending file to DB, retrying in 10 seconds!")
-        time.sleep(10)
-        sendToDB(db, data, dest, docName)
+# Retries of batch commits, gives up after DB_RETRY_BUDGET seconds so the upload
+# thread moves on and the ride is retried on the next pass
+DB_RETRY_BUDGET = 300
+DB_RETRY = retry.retryPolicy("commitWrites", budget=DB_RETRY_BUDGET, baseDelay=2.0, maxDelay=60.0,
+                             classify=isRetryableDbError)
+
+# Logs a failed database write
+def logDbFailure(exc, attempt, delay):
+    with open(ERR_LOG, "a") as errorLog:
+        errorLog.write(str(datetime.datetime.now())+"\n")
+        if delay is None:
+            errorLog.write(f"Giving up committing to DB after {attempt} attempts.\n")
+        else:
+            errorLog.write(f"Attempt {attempt} committing to DB failed, retrying in {delay:.1f} seconds.\n")
+        traceback.print_tb(exc.__traceback__, file=errorLog)
+
+# Parses a timestamp written by str(datetime.datetime) (DATE, with or without microseconds)
+# fromisoformat is implemented in C and is many times faster than strptime
+parseTime = datetime.datetime.fromisoformat
+
+# Reads the lines of fn with null characters (result from abrupt power loss) removed as they are read
+# The file itself is left untouched
+#
+# @f: open file to read
+def stripNulls(f):
+    for line in f:
+        if '\x00' in line:
+            line = line.replace('\x00', '')
+        yield line
+
+# Parses the columns named in columns out of the csv fn in a single pass
+# Header names are resolved to column indices once, rows that can't be parsed
+# (partially written or null rows) are skipped so every column stays the same length
+#
+# @fn: path to csv file
+# @columns: dictionary of header name -> function converting a cell to its value,
+#           columns converted with float are collected in a typed array
+# Returns a dictionary of header name -> list of values (empty if the column is missing)
+def parseColumns(fn, columns):
+    buffers = {name: array.array('d') if convert is float else [] for name, convert in columns.items()}
+    with open(fn, 'r', newline='') as f:
+        reader = csv.reader(stripNulls(f))
+        headers = next(reader, [])
+        # (index, convert, buffer) for every requested column present in the file
+        fields = [(headers.index(name), convert, buffers[name]) for name, convert in columns.items() if name in headers]
+        for row in reader:
+            try:
+                values = [convert(row[i]) for i, convert, _ in fields]
+            except (ValueError, IndexError):
+                continue
+            for value, (_, _, buffer) in zip(values, fields):
+                buffer.append(value)
+
+    return {name: buffer.tolist() if isinstance(buffer, array.array) else buffer for name, buffer in buffers.items()}
 
-# Remove null characters that may appear when the device suddenly loses power
+# Reads the named columns of a ride file, binary (rideFormat) files are read
+# through a memory mapped view with no parsing
 #
-# @fn: file to be cleaned
-# Replaces fn with a cleaned version, works with any file type that doesn't require spaces
-def cleanFile(fn):
-    cleanedText = ""
-    # Use a regex to remove null and whitespace characters from csv
-    with open(fn, 'r') as f:
-        for line in f:
-            result = re.sub(r'\x00+',"",str(line))
-            cleanedText += result
-
-    # Write cleaned file out
-    with open(fn, 'w') as outFile:
-        outFile.write(cleanedText)
+# @fn: path to a .csv or binary ride file
+# @columns: dictionary of header name -> function converting a .csv cell to its value
+# Returns a dictionary of header name -> list of values
+def readColumns(fn, columns):
+    if fn.endswith(rideFormat.EXTENSION):
+        return rideFormat.readColumns(fn, list(columns))
+    return parseColumns(fn, columns)
 
 # Collects all GPS data from a csv file containing GPS data and returns it as a dictionary
 #
-# @fn: path to file containing gps data
+# @fn: path to file (.csv or binary) containing gps data
 # Returns a dictionary containing all columns from the file as lists
 def getGPS(fn):
-    line = 0
-    didRollover = False
-    headers = []
-    times,locations,velocities,altitudes,satellites,accelXs,accelYs,accelZs,ros = [],[],[],[],[],[],[],[],[]
-
-    # Clean out possible null characters (result from abrupt power loss)
-    cleanFile(fn)
-    # Parse GPS
-    with open(fn, 'r') as f:
-        reader = csv.reader(f)
-        for row in reader:
-            # Reset lat and long params for geopoint call
-            latSet = False
-            longSet = False
-
-            if(line == 0):
-                for header in row:
-                    headers.append(header)
-                line += 1
-            else:
-                for i, item in enumerate(row):
-                    if(headers[i] == 'time'):
-                        times.append(datetime.datetime.strptime(item,DATE))
-                    elif(headers[i] == 'lat'):
-                        lat = float(item)
-                        latSet = True
-                    elif(headers[i] == 'long'):
-                        long = float(item)
-                        longSet = True
-                    elif(headers[i] == 'sats'):
-                        satellites.append(float(item))
-                    elif(headers[i] == 'vel'):
-                        velocities.append(float(item))
-                    elif(headers[i] == 'alt'):
-                        altitudes.append(float(item))
-                    elif(headers[i] == 'accelX'):
-                        accelXs.append(float(item))
-                    elif(headers[i] == 'accelY'):
-                        accelYs.append(float(item))
-                    elif(headers[i] == 'accelZ'):
-                        accelZs.append(float(item))
-                    elif(headers[i] == 'rollover'):
-                        ros.append(item)
-                        if item == True:
-                            didRollover = True
-
-                    # Create GeoPoint from both lat and long
-                    if(latSet and longSet):
-                        latSet = False
-                        longSet = False
-                        locations.append(firestore.GeoPoint(lat, long))
-                line += 1
-
-    terrainPoints = []
-    for i in range(0, len(accelXs)):
-        terrainPoints.append(TerrainPoint(accelXs[i],accelYs[i],accelZs[i],ros[i]).to_dict())
+    cols = readColumns(fn, {
+        'time': parseTime,
+        'lat': float,
+        'long': float,
+        'vel': float,
+        'alt': float,
+        'sats': float,
+        'accelX': float,
+        'accelY': float,
+        'accelZ': float,
+        'rollover': str
+    })
+
+    locations = [firestore.GeoPoint(lat, long) for lat, long in zip(cols['lat'], cols['long'])]
+    terrainPoints = [TerrainPoint(x, y, z, ro).to_dict()
+                     for x, y, z, ro in zip(cols['accelX'], cols['accelY'], cols['accelZ'], cols['rollover'])]
 
     res = {
         u'coordinates': locations,
-        u'gps_timestamps': times,
-        u'velocities': velocities,
-        u'altitudes': altitudes,
-        u'satellites': satellites,
+        u'gps_timestamps': cols['time'],
+        u'velocities': cols['vel'],
+        u'altitudes': cols['alt'],
+        u'satellites': cols['sats'],
         # IMU data, here for iOS db code compatibility
-        u'terrain_timestamps': times,
-        u'did_rollover': didRollover,
+        u'terrain_timestamps': cols['time'],
+        u'did_rollover': 'True' in cols['rollover'],
         u'terrain_point': terrainPoints
     }
     return res
 
 # Collects all IMU information from an imu.csv file fn and returns it in a dictionary
 #
-# @fn: expects path to a csv containing imu data
+# @fn: expects path to a csv (or binary ride file) containing imu data
 # Returns dictionary containing all columns in lists
 def getIMU(fn):
-    line = 0
-    headers = []
-    times,accelXs,accelYs,accelZs,gyroXs,gyroYs,gyroZs,possRolls,ros = [],[],[],[],[],[],[],[],[]
-
-    # Clean out possible null characters (result from abrupt power loss)
-    cleanFile(fn)
-    # Parse IMU
-    with open(fn, 'r') as f:
-        reader = csv.reader(f)
-        for row in reader:
-            if(line == 0):
-                for header in row:
-                    headers.append(header)
-                line += 1
-            else:
-                for i, item in enumerate(row):
-                    if(headers[i] == 'time'):
-                        times.append(datetime.datetime.strptime(item,DATE))
-                    elif(headers[i] == 'accelX'):
-                        accelXs.append(float(item))
-                    elif(headers[i] == 'accelY'):
-                        accelYs.append(float(item))
-                    elif(headers[i] == 'accelZ'):
-                        accelZs.append(float(item))
-                    elif(headers[i] == 'gyroX'):
-                        gyroXs.append(float(item))
-                    elif(headers[i] == 'gyroY'):
-                        gyroYs.append(float(item))
-                    elif(headers[i] == 'gyroZ'):
-                        gyroZs.append(float(item))
-                    elif(headers[i] == 'possibleRoll'):
-                        possRolls.append(item)
-                    elif(headers[i] == 'rollover'):
-                        ros.append(item)
-            line += 1
+    cols = readColumns(fn, {
+        'time': parseTime,
+        'accelX': float,
+        'accelY': float,
+        'accelZ': float,
+        'gyroX': float,
+        'gyroY': float,
+        'gyroZ': float,
+        'possibleRoll': str,
+        'rollover': str
+    })
 
     res = {
-        "times": times,
-        "accelX": accelXs,
-        "accelY": accelYs,
-        "accelZ": accelZs,
-        "gyroX": gyroXs,
-        "gyroY": gyroYs,
-        "gyroZ": gyroZs,
-        "possRoll": possRolls,
-        "rollover": ros
+        "times": cols['time'],
+        "accelX": cols['accelX'],
+        "accelY": cols['accelY'],
+        "accelZ": cols['accelZ'],
+        "gyroX": cols['gyroX'],
+        "gyroY": cols['gyroY'],
+        "gyroZ": cols['gyroZ'],
+        "possRoll": cols['possibleRoll'],
+        "rollover": cols['rollover']
     }
     return res
 
 
-# Sends file data corresponding to the files generated for rideName
+# Returns the shared Firestore client, configuring the Firebase Admin SDK the first time
+# Safe to call from multiple upload threads
+def getClient():
+    global client
+    with clientLock:
+        if client is None:
+            # Checks protected member to see if session already exists
+            if not firebase_admin._apps:
+                cred = credentials.Certificate(CERT)
+                firebase_admin.initialize_app(cred)
+            client = firestore.client()
+    return client
+
+# Parses a ride file into the document to upload
 #
-# @filename: expects a string representing the ride whose IMU and GPS data is going to be sent to the db
-def sendFileToDb(filename):
+# @filename: path of a GPS (rideN.csv) or IMU (rideN_imu.csv) ride file
+# Returns a tuple of (destination collection, document name, document data)
+def buildRideDoc(filename):
     # Extract index number from filename
-    regex = re.compile(r'\d+')
-    postIndex = regex.findall(filename)[0]
-
-    # Configure Firebase Admin SDK, checks protected member to see if session already exists
-    if not firebase_admin._apps:
-        cred = credentials.Certificate(CERT)
-        app = firebase_admin.initialize_app(cred)
-    db = firestore.client()
+    postIndex = re.compile(r'\d+').findall(os.path.basename(filename))[0]
 
     # Collect data from gps or imu file
     if "_imu" in filename:
-        print(filename + " is an imu file")
-        try:
-            imuData = getIMU(filename)
-            imuData["dev_id"] = DEVICE_NAME
-            imuData["index"] = int(postIndex)
-            print(imuData)
-#             sendToDB(db, imuData, "imuhistoryDev", RIDE_NAME+postIndex+"_imu")
-            sendToDB(db, imuData, "imuhistory", None)
-        except:
-            print("Unable to send " + filename)
+        data = getIMU(filename)
+        dest = "imuhistory"
+        docName = f"{DEVICE_NAME}_{RIDE_NAME}{postIndex}_imu"
     else:
-        print(filename + " is a gps file")
-        try:
-            gpsData = getGPS(filename)
-            gpsData["dev_id"] = DEVICE_NAME
-            gpsData["index"] = int(postIndex)
-            print(gpsData)
-#             sendToDB(db, gpsData, "ridehistoryDev", RIDE_NAME+postIndex)
-            sendToDB(db, gpsData, "ridehistory", None)
-        except:
-            with open(ERR_LOG, "a") as errorLog:
-                errorLog.write(str(datetime.datetime.now())+"\n")
-                errorLog.write(f"Unable to send: {filename} to database.\n")
+        data = getGPS(filename)
+        dest = "ridehistory"
+        docName = f"{DEVICE_NAME}_{RIDE_NAME}{postIndex}"
+    data["dev_id"] = DEVICE_NAME
+    data["index"] = int(postIndex)
+    return dest, docName, data
+
+# Splits a ride document into a summary and pages of at most pageRows rows
+# Every list in data is a column and is split across the pages, everything else goes in the summary
+#
+# @data: ride document built by buildRideDoc
+# @pageRows: number of rows per page
+# Returns a tuple of (summary dictionary, list of page dictionaries)
+def splitPages(data, pageRows):
+    columns = {key: value for key, value in data.items() if isinstance(value, list)}
+    summary = {key: value for key, value in data.items() if not isinstance(value, list)}
+
+    rows = max([len(column) for column in columns.values()] + [0])
+    times = data.get("gps_timestamps", data.get("times", []))
+    pages = []
+    for page, start in enumerate(range(0, rows, pageRows)):
+        pageData = {key: column[start:start + pageRows] for key, column in columns.items()}
+        pageData["page"] = page
+        pageData["index"] = data["index"]
+        pages.append(pageData)
+
+    summary["row_count"] = rows
+    summary["page_rows"] = pageRows
+    summary["page_count"] = len(pages)
+    summary["start_time"] = times[0] if times else None
+    summary["end_time"] = times[-1] if times else None
+    return summary, pages
+
+# Commits a list of (document reference, data) writes as a single WriteBatch,
+# retries (see DB_RETRY) if no connection
+# Document names are fixed, so committing the same writes again is harmless
+#
+# @db: firestore client
+# @writes: list of (document reference, data) tuples
+# Raises the last exception if the commit was rejected or the retry budget ran out
+def commitWrites(db, writes):
+    # A new batch for every attempt, a batch can't be committed twice
+    def commit():
+        batch = db.batch()
+        for document, data in writes:
+            batch.set(document, data)
+        return batch.commit()
+    return DB_RETRY.call(commit, onFailure=logDbFailure)
+
+# Uploads a ride file as a parent document holding summary fields with a "pages"
+# subcollection of fixed size pages, so no document reaches the Firestore size limit
+# Pages are committed in parallel on pagePool, PAGES_PER_BATCH to a WriteBatch
+# The parent is written last, a ride whose parent exists has all page_count pages
+# Progress is checkpointed in the ride's uploadManifest, pages committed by an
+# earlier (interrupted) attempt are skipped
+#
+# @db: firestore client
+# @filename: path of the ride file
+# @pagePool: executor the page commits run on
+# Returns True if every page and the parent were committed
+def uploadRideFile(db, filename, pagePool):
+    manifest = uploadManifest.uploadManifest(filename, MANIFESTS)
+    if manifest.isDone():
+        return True
+
+    try:
+        dest, docName, data = buildRideDoc(filename)
+        summary, pages = splitPages(data, PAGE_ROWS)
+        manifest.begin(len(pages), PAGE_ROWS)
+        parent = db.collection(dest).document(docName)
+        writes = [(parent.collection("pages").document(f"{page['page']:05d}"), page)
+                  for page in pages if not manifest.isCommitted(page['page'])]
+        groups = [writes[i:i + PAGES_PER_BATCH] for i in range(0, len(writes), PAGES_PER_BATCH)]
+
+        # Commits a group of pages and checkpoints them
+        def commitPages(group, extra=None):
+            commitWrites(db, group + (extra or []))
+            manifest.markCommitted([page['page'] for _, page in group])
+
+        if len(groups) <= 1:
+            # Small ride (or only one group left), the pages and parent fit in one commit
+            commitPages(groups[0] if groups else [], [(parent, summary)])
+        else:
+            futures = [pagePool.submit(commitPages, group) for group in groups]
+            # Wait for every group so all successful commits are checkpointed before failing
+            concurrent.futures.wait(futures)
+            for future in futures:
+                future.result()
+            commitWrites(db, [(parent, summary)])
+        manifest.finish()
+        return True
+    except Exception as exc:
+        with open(ERR_LOG, "a") as errorLog:
+            errorLog.write(str(datetime.datetime.now())+"\n")
+            errorLog.write(f"Unable to send: {filename} to database, {len(manifest.committed)} pages committed.\n")
+            traceback.print_tb(exc.__traceback__, file=errorLog)
+        return False
+
+# Uploads ride files concurrently, see uploadRideFile
+#
+# @filenames: list of ride file paths to upload
+# @workers: number of rides (and pages) uploaded at once
+# @db: firestore client to use, defaults to the shared client
+# Returns a dictionary of file path -> True if it was committed
+def uploadRides(filenames, workers=UPLOAD_WORKERS, db=None):
+    if db is None:
+        db = getClient()
+    workers = max(1, workers)
+    # Rides wait on their pages, so pages get their own pool to avoid deadlock
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as ridePool, \
+         concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pagePool:
+        sent = ridePool.map(lambda filename: uploadRideFile(db, filename, pagePool), filenames)
+        return dict(zip(filenames, sent))
+
+# Sends file data corresponding to the files generated for rideName
+#
+# @filename: expects a string representing the ride whose IMU and GPS data is going to be sent to the db
+# Returns True if the file was committed, False if it should be retried later
+def sendFileToDb(filename):
+    return uploadRides([filename])[filename]
+
+# Removes the upload manifest of a ride file once it has been moved out of unsent
+#
+# @filename: path the ride file was uploaded from
+def finishUpload(filename):
+    uploadManifest.uploadManifest(filename, MANIFESTS).remove()
@@ -0,0 +1,114 @@
+#!/usr/bin/python3
+# Level gated console output for the sampling hot path
+#
+# Messages are queued as a format string and its arguments, formatting and printing
+# happen on a background thread so the caller never waits on the terminal
+# A message below the current level returns after a single comparison
+import os
+import sys
+import time
+import atexit
+import threading
+import collections
+
+DEBUG = 10
+INFO = 20
+WARN = 30
+ERROR = 40
+OFF = 100
+
+LEVELS = {"debug": DEBUG, "info": INFO, "warn": WARN, "error": ERROR, "off": OFF}
+
+# Maximum number of messages waiting to be printed, the oldest are dropped when full
+RING_SIZE = 1024
+# Seconds between drains of the ring
+DRAIN_PERIOD = 0.2
+
+level = DEBUG
+ring = collections.deque(maxlen=RING_SIZE)
+dropped = 0
+drainer = None
+drainerLock = threading.Lock()
+
+# Sets the lowest level that is printed
+#
+# @newLevel: one of the level constants, or its name (debug, info, warn, error, off)
+def setLevel(newLevel):
+    global level
+    if isinstance(newLevel, str):
+        newLevel = LEVELS[newLevel.strip().lower()]
+    level = newLevel
+
+# Returns True if messages at msgLevel are printed, for skipping work that only feeds a message
+def enabled(msgLevel):
+    return msgLevel >= level
+
+# Queues a message, fmt is formatted with str.format(*args) when it is printed
+#
+# @msgLevel: level of the message
+# @fmt: format string
+# @args: values for fmt, these should not be changed after the call
+def log(msgLevel, fmt, *args):
+    global dropped
+    if msgLevel < level:
+        return
+    if len(ring) == RING_SIZE:
+        dropped += 1
+    ring.append((fmt, args))
+    if drainer is None:
+        startDrainer()
+
+def debug(fmt, *args):
+    if DEBUG >= level:
+        log(DEBUG, fmt, *args)
+
+def info(fmt, *args):
+    if INFO >= level:
+        log(INFO, fmt, *args)
+
+def warn(fmt, *args):
+    if WARN >= level:
+        log(WARN, fmt, *args)
+
+def error(fmt, *args):
+    if ERROR >= level:
+        log(ERROR, fmt, *args)
+
+# Formats and prints every queued message
+def drain():
+    global dropped
+    lines = []
+    while True:
+        try:
+            fmt, args = ring.popleft()
+        except IndexError:
+            break
+        lines.append(fmt.format(*args) if args else fmt)
+    if dropped:
+        lines.append(f"({dropped} messages dropped)")
+        dropped = 0
+    if lines:
+        sys.stdout.write("\n".join(lines) + "\n")
+        sys.stdout.flush()
+
+def drainLoop():
+    while True:
+        time.sleep(DRAIN_PERIOD)
+        drain()
+
+# Starts the background thread that drains the ring
+def startDrainer():
+    global drainer
+    with drainerLock:
+        if drainer is None:
+            drainer = threading.Thread(target=drainLoop, name="diag", daemon=True)
+            drainer.start()
+            atexit.register(drain)
+
+# A forked child doesn't inherit the drain thread, start a new one on its first message
+def resetAfterFork():
+    global drainer, drainerLock
+    drainer = None
+    drainerLock = threading.Lock()
+
+os.register_at_fork(after_in_child=resetAfterFork)
@@ -0,0 +1,82 @@
+#!/usr/bin/python3
+import threading
+import collections
+import clock
+
+# Immutable snapshot of the GPS state after a sentence was parsed
+# utc is the GPS time (time.struct_time) of the fix, rxTime the monotonic() time of the
+# reader's clock the sentence was received
+gpsFix = collections.namedtuple('gpsFix', ['hasFix', 'latitude', 'longitude', 'speedKnots',
+                                           'altitude', 'satellites', 'utc', 'rxTime'])
+
+# Seconds to wait before reading again after the UART raised an exception
+ERROR_DELAY = 1.0
+
+# Thread that continuously drains the GPS UART so NMEA sentences never pile up
+#
+# Initilization takes an adafruit_gps.GPS object (or an object with the same attributes),
+# the clock times are read from and optional loopStats the time of each update is recorded in
+# Every GGA/RMC sentence is parsed as it arrives and published as a gpsFix in fix,
+# readers get the most recent snapshot with latest and its age with age
+# sentences counts the sentences parsed, fixes the RMC sentences (one per fix),
+# errors the exceptions raised while reading
+# fixRate gives the measured fixes per second
+class gpsReader(threading.Thread):
+    def __init__(self, gps, clock=clock.REAL, stats=None):
+        threading.Thread.__init__(self, name="gpsReader", daemon=True)
+        self.gps = gps
+        self.clock = clock
+        self.stats = stats
+        self.fix = None
+        self.sentences = 0
+        self.fixes = 0
+        self.errors = 0
+        self.rateStart = (clock.monotonic(), 0)
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                # Blocks until a sentence arrives or the UART times out
+                start = self.stats.timer() if self.stats is not None else None
+                updated = self.gps.update()
+                if self.stats is not None:
+                    self.stats.lap("gpsUpdate", start)
+                if not updated:
+                    continue
+            except Exception:
+                self.errors += 1
+                self.clock.wait(self.stopped, ERROR_DELAY)
+                continue
+
+            gps = self.gps
+            self.sentences += 1
+            sentence = getattr(gps, 'nmea_sentence', None)
+            if sentence is not None and sentence[3:6] == 'RMC':
+                self.fixes += 1
+            self.fix = gpsFix(gps.has_fix, gps.latitude, gps.longitude, gps.speed_knots,
+                              gps.altitude_m, gps.satellites, getattr(gps, 'timestamp_utc', None),
+                              self.clock.monotonic())
+
+    # Returns the most recent gpsFix, or None if no sentence has been parsed yet
+    def latest(self):
+        return self.fix
+
+    # Returns the number of seconds since the most recent sentence was received
+    def age(self):
+        fix = self.fix
+        if fix is None:
+            return float('inf')
+        return self.clock.monotonic() - fix.rxTime
+
+    # Returns the fixes per second received since the last call
+    def fixRate(self):
+        now, fixes = self.clock.monotonic(), self.fixes
+        start, startFixes = self.rateStart
+        self.rateStart = (now, fixes)
+        if now <= start:
+            return 0.0
+        return (fixes - startFixes) / (now - start)
+
+    def stop(self):
+        self.stopped.set()
@@ -0,0 +1,158 @@
+#!/usr/bin/python3
+# Timing of the sampling loop in fixed-bucket histograms
+#
+# Phases (IMU read, GPS update, file writes, ride history update, rollover check) record
+# their duration, periodic samples record how far each interval was from its period
+# (negative is early) so missing samples can be traced to the phase that held them up
+# Recording is a clock read and a bisect into a short list, histograms are never
+# reset, snapshots are appended to a stats file as one line of json each
+#
+# Usage: python3 loopStats.py ride3_loopStats.jsonl prints the last snapshot of a stats file
+import sys
+import json
+import bisect
+import clock
+
+# Upper edges (seconds) of the duration buckets, the last bucket holds anything longer
+DURATION_EDGES = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                  0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+# Upper edges (seconds) of the jitter buckets, interval minus period
+JITTER_EDGES = (-0.5, -0.1, -0.025, -0.01, -0.0025, -0.001, 0.001, 0.0025, 0.01, 0.025, 0.1,
+                0.5, 1.0, 5.0)
+
+# Fixed-bucket histogram of seconds
+#
+# Initilization takes the upper edges of the buckets, in increasing order
+# counts[i] is the number of values <= edges[i] (and above the edge before it),
+# counts[-1] the values above the last edge
+# Only one thread should record into a histogram, any thread can snapshot it
+class histogram:
+    def __init__(self, edges):
+        self.edges = edges
+        self.counts = [0] * (len(edges) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def record(self, value):
+        self.counts[bisect.bisect_left(self.edges, value)] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count else None,
+            "min": self.min,
+            "max": self.max,
+            "counts": list(self.counts)
+        }
+
+# Class holding the phase and jitter histograms of one ride
+#
+# Initilization takes the clock (a clock.realClock or clock.virtualClock) the loop runs on
+# and the timer phases are measured on, the real clock even in a replay since a virtual
+# clock doesn't move while work is being done
+# Time a phase with start = stats.timer() ... start = stats.lap("phase", start), which returns
+# the end time so consecutive phases can be chained
+# interval records the jitter of a periodic event, call it with the period and the
+# time (on the loop's clock, stats.now()) of every occurrence
+# Histograms are created on first use, each should be recorded from a single thread
+class loopStats:
+    def __init__(self, clock=clock.REAL, timer=clock.REAL):
+        self.now = clock.monotonic
+        self.timer = timer.monotonic
+        self.started = self.now()
+        self.phases = {}
+        self.jitter = {}
+        self.last = {}
+
+    # Records the time since start (from timer) in the histogram of phase
+    # Returns the current time of timer
+    def lap(self, phase, start):
+        end = self.timer()
+        hist = self.phases.get(phase)
+        if hist is None:
+            hist = self.phases[phase] = histogram(DURATION_EDGES)
+        hist.record(end - start)
+        return end
+
+    # Records how far the time since the previous occurrence of name is from period
+    #
+    # @name: name of the periodic event (e.g. imuSample)
+    # @period: expected seconds between occurrences
+    # @t: time of this occurrence
+    def interval(self, name, period, t):
+        last = self.last.get(name)
+        self.last[name] = t
+        if last is None:
+            return
+        hist = self.jitter.get(name)
+        if hist is None:
+            hist = self.jitter[name] = histogram(JITTER_EDGES)
+        hist.record(t - last - period)
+
+    # Returns a dictionary of every histogram, extra is merged into it (counters such as dropped samples)
+    def snapshot(self, extra=None):
+        snap = {
+            "elapsed": self.now() - self.started,
+            "durationEdges": DURATION_EDGES,
+            "jitterEdges": JITTER_EDGES,
+            "phases": {name: hist.snapshot() for name, hist in list(self.phases.items())},
+            "jitter": {name: hist.snapshot() for name, hist in list(self.jitter.items())}
+        }
+        if extra:
+            snap.update(extra)
+        return snap
+
+    # Appends a snapshot to fn as a line of json
+    def dump(self, fn, extra=None):
+        line = json.dumps(self.snapshot(extra), default=str) + "\n"
+        with open(fn, "a") as statsFile:
+            statsFile.write(line)
+
+# Returns the upper edge of the bucket holding fraction q of the values of a histogram
+# snapshot (the maximum for the last bucket)
+def snapshotQuantile(hist, edges, q):
+    target, seen = q * hist["count"], 0
+    for edge, n in zip(edges, hist["counts"]):
+        seen += n
+        if seen >= target:
+            return min(edge, hist["max"])
+    return hist["max"]
+
+# Formats seconds as milliseconds for the summary table
+def ms(value):
+    return "-" if value is None else f"{value * 1000:.2f}"
+
+# Prints the last snapshot of a stats file
+def main():
+    if len(sys.argv) != 2:
+        print("Usage: python3 loopStats.py <stats file>")
+        sys.exit(1)
+    with open(sys.argv[1]) as statsFile:
+        lines = [line for line in statsFile if line.strip()]
+    if not lines:
+        print("No snapshots")
+        return
+    snap = json.loads(lines[-1])
+    print(f"{len(lines)} snapshots, last after {snap['elapsed']:.0f}s")
+    for title, key, edges in (("phase (ms)", "phases", snap["durationEdges"]),
+                              ("jitter (ms)", "jitter", snap["jitterEdges"])):
+        print(f"{title:<16} {'count':>8} {'mean':>8} {'p50':>8} {'p99':>8} {'min':>8} {'max':>8}")
+        for name, hist in sorted(snap[key].items()):
+            if hist["count"] == 0:
+                continue
+            print(f"{name:<16} {hist['count']:>8} {ms(hist['mean']):>8} {ms(snapshotQuantile(hist, edges, 0.5)):>8} "
+                  f"{ms(snapshotQuantile(hist, edges, 0.99)):>8} {ms(hist['min']):>8} {ms(hist['max']):>8}")
+    for name, value in snap.items():
+        if name not in ("elapsed", "durationEdges", "jitterEdges", "phases", "jitter"):
+            print(f"{name}: {value}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+#!/usr/bin/python3
+# Roll and pitch of the device from the IMU's gyroscope and accelerometer
+#
+# A complementary filter: the gyro rates are integrated for the short term and the
+# estimate is pulled towards the angles of the accelerometer's gravity vector with a
+# time constant, so bumps (short accelerometer spikes) are smoothed out while the gyro's
+# drift is corrected. Readings far from 1 g (impacts, hard acceleration) don't correct
+# the estimate at all. Each update is a handful of trig calls, O(1) per reading
+# A Madgwick filter would add yaw from the magnetometer, which rollover detection doesn't need
+import math
+
+# Standard gravity (m/s^2)
+G = 9.80665
+# Largest difference from 1 g (as a fraction of g) of an accelerometer reading used for correction
+ACCEL_GATE = 0.25
+# Largest tan(pitch) used when converting body rates, avoids the singularity at +-90 degrees pitch
+MAX_TAN_PITCH = 50.0
+
+# Returns angle wrapped into [-pi, pi)
+def wrap(angle):
+    return (angle + math.pi) % (2 * math.pi) - math.pi
+
+# Returns the roll and pitch (radians) of the gravity vector measured by the accelerometer
+# Roll is about the x axis, 0 upright and +-pi upside down, pitch about the y axis
+def accelAngles(accelX, accelY, accelZ):
+    return math.atan2(accelY, accelZ), math.atan2(-accelX, math.sqrt(accelY * accelY + accelZ * accelZ))
+
+# Class estimating roll and pitch from a stream of IMU readings
+#
+# Initilization takes the time constant (seconds) of the accelerometer correction,
+# longer trusts the gyro for longer and smooths rough ground more
+# Call update with every reading and its monotonic time, the first reading
+# starts the estimate from the accelerometer alone
+# roll and pitch are in radians, gravity gives the gravity vector they imply (m/s^2,
+# in the accelerometer's frame) for checks written against accelerometer readings
+class orientationFilter:
+    def __init__(self, timeConstant=0.5):
+        self.timeConstant = timeConstant
+        self.roll = 0.0
+        self.pitch = 0.0
+        self.last = None
+
+    # Updates the estimate with one reading
+    #
+    # @t: monotonic time of the reading (seconds)
+    # @accelX, accelY, accelZ: acceleration (m/s^2)
+    # @gyroX, gyroY, gyroZ: angular rates (degrees/s, as the LSM9DS1 driver reports them)
+    #
+    # Returns the tuple (roll, pitch)
+    def update(self, t, accelX, accelY, accelZ, gyroX, gyroY, gyroZ):
+        accelRoll, accelPitch = accelAngles(accelX, accelY, accelZ)
+        if self.last is None:
+            self.last = t
+            self.roll, self.pitch = accelRoll, accelPitch
+            return self.roll, self.pitch
+        dt, self.last = t - self.last, t
+        if dt <= 0:
+            return self.roll, self.pitch
+
+        # Body rates to Euler angle rates
+        p, q, r = math.radians(gyroX), math.radians(gyroY), math.radians(gyroZ)
+        sinRoll, cosRoll = math.sin(self.roll), math.cos(self.roll)
+        tanPitch = max(-MAX_TAN_PITCH, min(MAX_TAN_PITCH, math.tan(self.pitch)))
+        roll = self.roll + (p + (q * sinRoll + r * cosRoll) * tanPitch) * dt
+        pitch = self.pitch + (q * cosRoll - r * sinRoll) * dt
+
+        # Pull towards the accelerometer's angles unless the reading isn't mostly gravity
+        norm = math.sqrt(accelX * accelX + accelY * accelY + accelZ * accelZ)
+        if abs(norm - G) <= ACCEL_GATE * G:
+            weight = dt / (self.timeConstant + dt)
+            roll += weight * wrap(accelRoll - roll)
+            pitch += weight * (accelPitch - pitch)
+
+        self.roll = wrap(roll)
+        self.pitch = max(-math.pi / 2, min(math.pi / 2, pitch))
+        return self.roll, self.pitch
+
+    # Returns the (x, y, z) gravity vector of the estimate in m/s^2
+    def gravity(self):
+        cosPitch = math.cos(self.pitch)
+        return (-G * math.sin(self.pitch), G * math.sin(self.roll) * cosPitch, G * math.cos(self.roll) * cosPitch)
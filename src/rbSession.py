@@ -0,0 +1,95 @@
+#!/usr/bin/python3
+import time
+import rockBlock
+
+# Seconds between refreshes of the cached network time and signal state
+REFRESH_SECS = 60.0
+# Seconds the cached state is trusted for, an older state is checked again before sending
+MAX_AGE = 180.0
+# Lowest signal strength (0-5) a message is sent on, as rockBlock._attemptConnection
+SIGNAL_THRESHOLD = 2
+
+# Class keeping one RockBLOCK connection open and configured between messages
+#
+# Initilization takes the serial port of the RockBLOCK, the port is opened (and
+# configured) by open, or on the first refresh or send
+# refresh polls network time and signal strength and caches them, while the cached
+# state is fresh and good enough send queues the message and starts the SBD session
+# straight away instead of waiting for network time and signal again
+# Not thread safe, it should only be used from one thread (the satTransmitter)
+# A serial error closes the port, it is reopened on the next call
+class rbSession:
+    def __init__(self, port, refreshSecs=REFRESH_SECS, maxAge=MAX_AGE, clock=time.monotonic):
+        self.port = port
+        self.refreshSecs = refreshSecs
+        self.maxAge = maxAge
+        self.clock = clock
+        self.rb = None
+        # rockBlock needs a callback to connect, events outside a send go nowhere
+        self.idle = rockBlock.rockBlockProtocol()
+        self.timeValid = False
+        self.signal = -1
+        self.updated = None
+        self.attempted = None
+
+    def open(self):
+        if self.rb is None:
+            self.rb = rockBlock.rockBlock(self.port, self.idle)
+
+    def close(self):
+        if self.rb is not None:
+            try:
+                self.rb.close()
+            finally:
+                self.rb = None
+        self.updated = None
+
+    # Polls network time and signal strength
+    # Returns True if a message could be sent without waiting
+    def refresh(self):
+        self.attempted = self.clock()
+        try:
+            self.open()
+            self.timeValid = bool(self.rb.networkTime())
+            self.signal = self.rb.requestSignalStrength()
+            self.updated = self.clock()
+        except Exception:
+            self.close()
+            raise
+        return self.ready()
+
+    # Returns the number of seconds until the next refresh is due, refreshSecs after the
+    # last attempt (successful or not) unless the state was invalidated since
+    def untilRefresh(self):
+        if self.attempted is None:
+            return 0.0
+        return max(0.0, self.attempted + self.refreshSecs - self.clock())
+
+    # Returns True if the cached state is fresh and good enough to send on
+    def ready(self):
+        return self.updated is not None and self.clock() - self.updated <= self.maxAge\
+               and self.timeValid and self.signal >= SIGNAL_THRESHOLD
+
+    # Sends content, events are reported to callback (a rockBlockProtocol)
+    # Returns True if the message was sent
+    def send(self, content, callback):
+        ready = self.ready()
+        try:
+            self.open()
+            self.rb.callback = callback
+            sent = self.rb.sendMessage(content, checkConnection=not ready)
+        except Exception:
+            self.close()
+            raise
+        finally:
+            if self.rb is not None:
+                self.rb.callback = self.idle
+        if not sent:
+            self.invalidate()
+        return sent
+
+    # Forgets the cached state, network time and signal are checked from scratch
+    # before the next message and refreshed as soon as possible
+    def invalidate(self):
+        self.updated = None
+        self.attempted = None
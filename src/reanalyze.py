@@ -0,0 +1,95 @@
+#!/usr/bin/python3
+# Re-runs rollover detection over recorded IMU logs (e.g. imuComplete rides) so the
+# cone thresholds can be evaluated offline, on a workstation as well as on the pi
+#
+# Usage: python3 reanalyze.py [--min MIN] [--max MAX] [--sensitivity K] [files or directories...]
+import os
+import os.path
+import argparse
+import warnings
+import numpy as np
+from xml.dom import minidom
+
+import cone
+import rideFormat
+
+IMU_FULL_REC_PATH = "/home/pi/kadd-pi/data/rides/imuComplete/"
+CONFIG = "/home/pi/kadd-pi/data/about.xml"
+
+# Reads the cone parameters from the config, falling back to the sensors.py defaults
+#
+# Returns a tuple of (minAccel, maxAccel, sensitivity)
+def configCone():
+    if os.path.isfile(CONFIG):
+        config = minidom.parse(CONFIG)
+        return (float(config.getElementsByTagName('coneMinAccel')[0].firstChild.data),
+                float(config.getElementsByTagName('coneMaxAccel')[0].firstChild.data),
+                float(config.getElementsByTagName('coneSensitivity')[0].firstChild.data))
+    return (-11.0, -1.0, 2.0)
+
+# Loads the accelerometer columns of an IMU .csv or binary ride file
+#
+# @fn: path to a file containing imu data
+#
+# Returns an array of shape (n, 3) holding (accelX, accelY, accelZ) rows
+def loadAccel(fn):
+    if fn.endswith(rideFormat.EXTENSION):
+        kind, records = rideFormat.load(fn)
+        records = records[np.isin(records['tag'], (rideFormat.TAG_IMU, rideFormat.TAG_GPS))]
+        return np.column_stack((records['accelX'], records['accelY'], records['accelZ'])).astype(np.float64)
+
+    with open(fn, 'r') as f:
+        # Remove null characters that may appear when the device suddenly loses power
+        lines = [line.replace('\x00', '') for line in f]
+    headers = lines[0].strip().split(',')
+    columns = [headers.index('accelX'), headers.index('accelY'), headers.index('accelZ')]
+    with warnings.catch_warnings():
+        # Partially written rows are expected after a power loss and dropped below
+        warnings.simplefilter("ignore")
+        accel = np.genfromtxt(lines[1:], delimiter=',', usecols=columns, dtype=np.float64, invalid_raise=False)
+    accel = accel.reshape(-1, 3)
+    # Drop rows that were only partially written
+    return accel[~np.isnan(accel).any(axis=1)]
+
+# Returns the length of the longest run of True values in mask
+def longestRun(mask):
+    if not mask.any():
+        return 0
+    # Indices where runs of True start and end
+    edges = np.diff(np.concatenate(([0], mask.astype(np.int8), [0])))
+    return int((np.flatnonzero(edges == -1) - np.flatnonzero(edges == 1)).max())
+
+# Expands the given paths into a sorted list of .csv and binary ride files
+def findFiles(paths):
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files += [os.path.join(path, fn) for fn in os.listdir(path)
+                      if fn.endswith('.csv') or fn.endswith(rideFormat.EXTENSION)]
+        else:
+            files.append(path)
+    return sorted(files)
+
+def main():
+    minAccel, maxAccel, sensitivity = configCone()
+    parser = argparse.ArgumentParser(description="Re-run rollover detection over recorded IMU logs")
+    parser.add_argument('paths', nargs='*', default=[IMU_FULL_REC_PATH])
+    parser.add_argument('--min', type=float, default=minAccel, help="coneMinAccel")
+    parser.add_argument('--max', type=float, default=maxAccel, help="coneMaxAccel")
+    parser.add_argument('--sensitivity', type=float, default=sensitivity, help="coneSensitivity")
+    args = parser.parse_args()
+
+    rolloverCone = cone.rolloverCone(args.min, args.max, args.sensitivity)
+    print(f"Cone: min {args.min}, max {args.max}, sensitivity {args.sensitivity}")
+    totalSamples, totalRolls = 0, 0
+    for fn in findFiles(args.paths):
+        accel = loadAccel(fn)
+        mask = rolloverCone.mask(accel)
+        rolls = int(mask.sum())
+        totalSamples += len(mask)
+        totalRolls += rolls
+        print(f"{fn}: {len(mask)} samples, {rolls} possible rolls, longest run {longestRun(mask)}")
+    print(f"Total: {totalSamples} samples, {totalRolls} possible rolls")
+
+if __name__ == "__main__":
+    main()
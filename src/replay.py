@@ -0,0 +1,263 @@
+#!/usr/bin/python3
+# Runs sensors.startSampling on recorded rides instead of the IMU and GPS, on a workstation
+# as well as on the pi, to measure loop throughput and rollover detection
+#
+# IMU samples come from an _imu, imuComplete or crash capture file (.csv or .bin),
+# GPS fixes from a ride file, on a virtual clock running at --speed times real time
+# (0 for as fast as possible). Sampling stops when the IMU recording runs out
+# Ride files, captures and the error log are written to --out, alerts are recorded
+# instead of sent
+#
+# Usage: python3 replay.py --imu ride3_imuComplete.csv [--gps ride3.csv] [--speed 0] [--mode 0]
+import os
+import os.path
+import csv
+import json
+import time
+import argparse
+import tempfile
+import datetime
+import numpy as np
+
+import clock
+import rideFormat
+import ringBuffer
+import diag
+import sensors
+
+# Nanoseconds in a second, for converting datetime64 differences
+NS = 1e9
+
+# Returns the rows of a .csv as dicts, with null characters (power loss) removed
+def readCsv(fn):
+    with open(fn, newline='') as f:
+        return list(csv.DictReader(line.replace('\x00', '') for line in f))
+
+# Loads the IMU samples of a .csv or binary ride file
+#
+# @fn: path to a file containing imu data
+#
+# Returns a tuple of (datetime64[us] times, (n, 6) array of accelX..gyroZ)
+def loadImu(fn):
+    if fn.endswith(rideFormat.EXTENSION):
+        kind, records = rideFormat.load(fn)
+        keep = np.isin(records['tag'], (rideFormat.TAG_IMU, rideFormat.TAG_GPS))
+        times, records = rideFormat.utcTimes(records)[keep], records[keep]
+        names = ringBuffer.IMU_FIELDS if kind == rideFormat.KIND_IMU else ringBuffer.IMU_FIELDS[:3]
+        values = np.zeros((len(records), 6))
+        for column, name in enumerate(names):
+            values[:, column] = records[name]
+        return times, values
+
+    times, values = [], []
+    for row in readCsv(fn):
+        try:
+            times.append(np.datetime64(row['time'].replace(' ', 'T'), 'us'))
+            values.append([float(row.get(name) or 0.0) for name in ringBuffer.IMU_FIELDS])
+        except (ValueError, TypeError, AttributeError):
+            continue
+    return np.array(times, dtype='M8[us]'), np.array(values, dtype=np.float64).reshape(-1, 6)
+
+# Loads the GPS fixes of a .csv or binary ride file, rows without a fix are left out
+#
+# @fn: path to a ride file
+#
+# Returns a list of (datetime64[us] time, lat, long, speed (kph), alt, sats) tuples
+def loadGps(fn):
+    if fn.endswith(rideFormat.EXTENSION):
+        kind, records = rideFormat.load(fn)
+        keep = records['tag'] == rideFormat.TAG_GPS
+        return [(time, float(r['lat']), float(r['long']), float(r['vel']), float(r['alt']), int(r['sats']))
+                for time, r in zip(rideFormat.utcTimes(records)[keep], records[keep])]
+
+    fixes = []
+    for row in readCsv(fn):
+        try:
+            fixes.append((np.datetime64(row['time'].replace(' ', 'T'), 'us'), float(row['lat']), float(row['long']),
+                          float(row['vel']), float(row['alt']), int(float(row['sats']))))
+        except (ValueError, TypeError, AttributeError):
+            continue
+    return fixes
+
+# IMU read back from a recording, returns the sample recorded at the clock's time
+#
+# Initilization takes the sample times (seconds since the start of the replay), the
+# (n, 6) sample values and the clock
+# Raises sensors.samplingStopped once the clock passes the end of the recording
+class replayImu:
+    def __init__(self, times, values, clock):
+        self.times = times
+        self.values = values
+        self.clock = clock
+        self.end = times[-1] + (np.median(np.diff(times)) if len(times) > 1 else 1.0)
+        self.reads = 0
+
+    def current(self):
+        if self.reads == 0:
+            # First read, from the sampler thread, see replayBackend.createImu
+            self.clock.join()
+            self.clock.release()
+        now = self.clock.monotonic()
+        if now > self.end:
+            raise sensors.samplingStopped()
+        self.reads += 1
+        return self.values[max(0, np.searchsorted(self.times, now, 'right') - 1)]
+
+    @property
+    def acceleration(self):
+        return tuple(self.current()[:3])
+
+    @property
+    def gyro(self):
+        return tuple(self.current()[3:])
+
+# GPS read back from a recording, with the attributes of adafruit_gps.GPS that gpsReader reads
+#
+# Initilization takes the fixes (seconds since the start of the replay, lat, long,
+# speed (kph), alt, sats) and the clock
+# update waits (on the clock, at most a second like the UART timeout) for the next
+# recorded fix and publishes it as an RMC sentence, with the recorded time as GPS time
+class replayGps:
+    def __init__(self, fixes, clock):
+        self.fixes = fixes
+        self.clock = clock
+        self.timestamp_utc = None
+        self.index = 0
+        self.has_fix = False
+        self.latitude = None
+        self.longitude = None
+        self.speed_knots = None
+        self.altitude_m = None
+        self.satellites = None
+        self.nmea_sentence = None
+        self.started = False
+
+    def update(self):
+        if not self.started:
+            # First update, from the reader thread, see replayBackend.createGps
+            self.started = True
+            self.clock.join()
+            self.clock.release()
+        if self.index >= len(self.fixes):
+            self.clock.wait(None, 1.0)
+            return False
+        fixTime, lat, long, speed, alt, sats = self.fixes[self.index]
+        delay = fixTime - self.clock.monotonic()
+        if delay > 0:
+            self.clock.wait(None, min(delay, 1.0))
+            if fixTime > self.clock.monotonic():
+                return False
+        self.index += 1
+        self.has_fix = True
+        self.latitude, self.longitude, self.altitude_m, self.satellites = lat, long, alt, sats
+        self.speed_knots = speed / sensors.CONV
+        self.timestamp_utc = (self.clock.start + datetime.timedelta(seconds=fixTime)).timetuple()
+        self.nmea_sentence = "$GPRMC"
+        return True
+
+    def send_command(self, command):
+        pass
+
+# Sensor backend replaying recorded IMU and GPS files, see sensors.hardwareBackend
+#
+# Initilization takes the IMU file, the GPS file (or None) and the speed (a multiple
+# of real time, None for as fast as possible)
+# Alerts sent by the loop are kept in alerts as (virtual time, message) tuples
+# A keyfob press can be replayed with pressKeyfob
+class replayBackend:
+    def __init__(self, imuFn, gpsFn=None, speed=None):
+        imuTimes, self.imuValues = loadImu(imuFn)
+        if len(imuTimes) == 0:
+            raise ValueError(f"No IMU samples in {imuFn}")
+        fixes = loadGps(gpsFn) if gpsFn else []
+        start = imuTimes[0]
+        self.clock = clock.virtualClock(start.astype(datetime.datetime), speed)
+        self.imuTimes = (imuTimes - start).astype('m8[ns]').astype(np.int64) / NS
+        self.fixes = [(float((fix[0] - start).astype('m8[ns]').astype(np.int64)) / NS,) + fix[1:]
+                      for fix in fixes if fix[0] >= start]
+        self.imu = None
+        self.gps = None
+        self.keyfob = None
+        self.alerts = []
+
+    def start(self):
+        pass
+
+    # The clock is held from creating a sensor until its thread first reads it, and the
+    # creating (main) thread joins it, so time can't move before every thread is running
+    def createImu(self):
+        self.clock.join()
+        self.clock.hold()
+        self.imu = replayImu(self.imuTimes, self.imuValues, self.clock)
+        return self.imu
+
+    def createGps(self, sampleRate):
+        self.clock.join()
+        self.clock.hold()
+        self.gps = replayGps(self.fixes, self.clock)
+        return self.gps
+
+    def watchKeyfob(self, callback):
+        self.keyfob = callback
+
+    def unwatchKeyfob(self):
+        self.keyfob = None
+
+    def pressKeyfob(self):
+        if self.keyfob is not None:
+            self.keyfob()
+
+    def sendMessage(self, content, callback):
+        self.alerts.append((self.clock.now(), content))
+
+    # Returns the number of seconds of recording
+    def duration(self):
+        return float(self.imuTimes[-1])
+
+# Points the sensors module's output paths at out, with a fresh ride history
+def redirectOutput(out):
+    for name, sub in (('PATH', 'current'), ('IMU_FULL_REC_PATH', 'imuComplete'), ('CAPTURE_PATH', 'captures'),
+                      ('STATS_PATH', 'stats')):
+        path = os.path.join(out, sub)
+        os.makedirs(path, exist_ok=True)
+        setattr(sensors, name, path + os.sep)
+    sensors.HISTORY = os.path.join(out, "rideHistory.json")
+    with open(sensors.HISTORY, "w") as rideHistoryJson:
+        json.dump({"lastRide": 0, "lastResearchRide": 0}, rideHistoryJson)
+    sensors.ERR_LOG = os.path.join(out, "errorLog.txt")
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay recorded IMU and GPS files through sensors.startSampling")
+    parser.add_argument('--imu', required=True, help="IMU .csv or .bin file to replay")
+    parser.add_argument('--gps', help="GPS ride .csv or .bin file to replay")
+    parser.add_argument('--speed', type=float, default=0.0, help="multiple of real time, 0 for as fast as possible")
+    parser.add_argument('--mode', type=int, default=0, help="device mode (0 = Farm, 1 = Research)")
+    parser.add_argument('--imu-rate', type=float, default=sensors.FARM_IMU_RATE, help="seconds between IMU samples")
+    parser.add_argument('--gps-rate', type=float, default=15, help="seconds between GPS samples")
+    parser.add_argument('--capture-rate', type=float, default=sensors.CAPTURE_RATE,
+                        help="crash capture samples per second, 0 turns captures off")
+    parser.add_argument('--out', help="directory for ride files and the error log (default: a temporary directory)")
+    parser.add_argument('--log-level', default="warn", help="console output level")
+    args = parser.parse_args()
+
+    out = args.out or tempfile.mkdtemp(prefix="replay")
+    redirectOutput(out)
+    diag.setLevel(args.log_level)
+    sensors.CAPTURE_RATE = args.capture_rate
+
+    backend = replayBackend(args.imu, args.gps, args.speed or None)
+    sensors.setBackend(backend)
+    start = time.perf_counter()
+    sensors.startSampling("ride", args.gps_rate, args.imu_rate, args.mode)
+    elapsed = time.perf_counter() - start
+    diag.drain()
+
+    print(f"Replayed {backend.duration():.1f}s of recording in {elapsed:.2f}s ({backend.duration() / elapsed:.1f}x real time)")
+    print(f"IMU reads: {backend.imu.reads if backend.imu else 0} ({(backend.imu.reads if backend.imu else 0) / elapsed:.0f}/s), "
+          f"GPS fixes: {backend.gps.index if backend.gps else 0}")
+    for alertTime, content in backend.alerts:
+        print(f"Alert at {alertTime}: {content.hex() if isinstance(content, bytes) else content}")
+    print(f"Output in {out}: {', '.join(sorted(os.path.relpath(os.path.join(d, f), out) for d, _, fs in os.walk(out) for f in fs))}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+#!/usr/bin/python3
+import time
+import random
+import threading
+
+# Errors that come from a bug or bad input rather than a lost connection or sensor,
+# retrying them can't succeed
+FATAL_ERRORS = (TypeError, ValueError, KeyError, AttributeError, NotImplementedError, PermissionError)
+
+# Returns True if exc is worth retrying, the default classification
+#
+# @exc: exception raised by an attempt
+def isRetryable(exc):
+    return not isinstance(exc, FATAL_ERRORS)
+
+# Class that retries a function with exponential backoff, in a loop rather than recursion
+#
+# Initilization takes the name of the policy (for logs) and its limits:
+# maxAttempts (None for no limit) and budget, the seconds of retrying allowed before
+# giving up (None for no limit)
+# The delay before retry n is baseDelay * multiplier**n capped at maxDelay, of which
+# up to jitter (a fraction) is randomly removed so devices recovering from the same
+# outage don't retry in lockstep
+# classify decides which exceptions are retried (isRetryable by default), the rest
+# are raised immediately
+# An attempt that ran for resetAfter seconds or more before failing starts the
+# backoff (and budget) over, for loops that are expected to run indefinitely
+# Counters (attempts, retries, successes, failures, fatal) are kept across calls, get them with stats
+class retryPolicy:
+    def __init__(self, name, maxAttempts=None, budget=None, baseDelay=1.0, maxDelay=60.0,
+                 multiplier=2.0, jitter=0.5, classify=isRetryable, resetAfter=None,
+                 clock=time.monotonic, sleep=time.sleep):
+        self.name = name
+        self.maxAttempts = maxAttempts
+        self.budget = budget
+        self.baseDelay = baseDelay
+        self.maxDelay = maxDelay
+        self.multiplier = multiplier
+        self.jitter = jitter
+        self.classify = classify
+        self.resetAfter = resetAfter
+        self.clock = clock
+        self.sleep = sleep
+        self.lock = threading.Lock()
+        self.attempts = 0
+        self.retries = 0
+        self.successes = 0
+        self.failures = 0
+        self.fatal = 0
+
+    # Returns the seconds to wait before retry number retry (starting at 0)
+    def delay(self, retry):
+        delay = min(self.maxDelay, self.baseDelay * self.multiplier ** min(retry, 64))
+        return delay * (1.0 - self.jitter * random.random())
+
+    # Calls fn(*args, **kwargs) until it returns, retrying retryable exceptions
+    #
+    # @fn: function to call
+    # @onFailure: optional function called with (exception, attempt number, seconds until
+    #             the next attempt or None if giving up) after every failed attempt
+    #
+    # Returns the result of fn
+    # Raises the last exception once it is fatal or the attempts or budget run out
+    def call(self, fn, *args, onFailure=None, **kwargs):
+        start = self.clock()
+        attempt = 0
+        retry = 0
+        while True:
+            attempt += 1
+            attemptStart = self.clock()
+            self.count("attempts")
+            try:
+                result = fn(*args, **kwargs)
+                self.count("successes")
+                return result
+            except Exception as exc:
+                now = self.clock()
+                if self.resetAfter is not None and now - attemptStart >= self.resetAfter:
+                    start = attemptStart
+                    retry = 0
+
+                if not self.classify(exc):
+                    self.count("fatal")
+                    delay = None
+                else:
+                    delay = self.delay(retry)
+                    if self.maxAttempts is not None and attempt >= self.maxAttempts:
+                        delay = None
+                    elif self.budget is not None and now + delay - start > self.budget:
+                        delay = None
+
+                if delay is None:
+                    self.count("failures")
+                if onFailure is not None:
+                    onFailure(exc, attempt, delay)
+                if delay is None:
+                    raise
+
+                self.count("retries")
+                retry += 1
+                self.sleep(delay)
+
+    def count(self, counter):
+        with self.lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    # Returns the counters as a dict
+    def stats(self):
+        with self.lock:
+            return {"attempts": self.attempts, "retries": self.retries, "successes": self.successes,
+                    "failures": self.failures, "fatal": self.fatal}
@@ -0,0 +1,89 @@
+#!/usr/bin/python3
+import os
+import os.path
+import json
+import time
+import atexit
+import threading
+
+# Stores that have been opened, keyed by file path, so every module shares the same counters
+stores = {}
+
+# Class that keeps the ride history counters in memory
+#
+# Initilization takes the path of the ride history json and the minimum
+# number of seconds between writes to it
+# Read counters with get or snapshot, change them with set
+# Changes are written out atomically (temp file and rename) at most once
+# every minInterval seconds, call flush to write them out immediately
+class rideCounter:
+    def __init__(self, fn, minInterval=10.0):
+        self.fn = fn
+        self.minInterval = minInterval
+        self.lock = threading.Lock()
+        self.dirty = False
+        self.lastWrite = 0.0
+        with open(fn) as rideHistoryJson:
+            self.counters = json.load(rideHistoryJson)
+
+    # Returns the value of the counter item
+    def get(self, item):
+        return self.counters[item]
+
+    # Returns a copy of all counters as a dictionary
+    def snapshot(self):
+        with self.lock:
+            return dict(self.counters)
+
+    # Sets the counter item to value, the file is only rewritten if the value changed
+    #
+    # @item: name of the counter
+    # @value: new value of the counter
+    def set(self, item, value):
+        with self.lock:
+            if self.counters.get(item) == value:
+                return
+            self.counters[item] = value
+            self.dirty = True
+        self.flush(force=False)
+
+    # Writes the counters out if they have changed
+    #
+    # @force: write even if the last write was less than minInterval seconds ago
+    def flush(self, force=True):
+        with self.lock:
+            if not self.dirty:
+                return
+            if not force and time.monotonic() - self.lastWrite < self.minInterval:
+                return
+
+            # Write to a temp file and rename it over the old file so a power loss
+            # leaves either the old or the new counters, never a partial file
+            tmp = self.fn + ".tmp"
+            with open(tmp, "w") as rideHistoryJson:
+                rideHistoryJson.write(json.dumps(self.counters))
+                rideHistoryJson.flush()
+                os.fsync(rideHistoryJson.fileno())
+            os.replace(tmp, self.fn)
+            dirFd = os.open(os.path.dirname(self.fn) or ".", os.O_RDONLY)
+            try:
+                os.fsync(dirFd)
+            finally:
+                os.close(dirFd)
+
+            self.dirty = False
+            self.lastWrite = time.monotonic()
+
+# Returns the shared rideCounter for the ride history json fn, opening it if needed
+#
+# @fn: path of the ride history json
+# @minInterval: minimum number of seconds between writes, leaves the current value if None
+def getStore(fn, minInterval=None):
+    store = stores.get(fn)
+    if store is None:
+        store = rideCounter(fn) if minInterval is None else rideCounter(fn, minInterval)
+        stores[fn] = store
+        atexit.register(store.flush)
+    elif minInterval is not None:
+        store.minInterval = minInterval
+    return store
@@ -0,0 +1,206 @@
+#!/usr/bin/python3
+# Compact binary ride format
+#
+# A ride file is a 16 byte header followed by fixed width records:
+#   header: magic (8 bytes), version (u16), kind (u16), record size (u16), reserved (u16)
+#   record: type tag (u8), flags (u8), then the packed fields of the file's kind
+# All values are little endian, times are int64 monotonic nanoseconds (clock.monotonicNs)
+# An anchor record (TAG_ANCHOR) holds the offset from monotonic to unix nanoseconds in its
+# time field, every time in the file is converted to UTC with the last anchor, see utcTimes
+# Version 1 files (times in int64 microseconds of local time) can still be read
+# Files are read through memory mapped NumPy views, see load and readColumns
+#
+# Usage: python3 rideFormat.py ride.bin [...]   (writes ride.csv next to each file)
+import os
+import os.path
+import sys
+import struct
+import numpy as np
+
+import ringBuffer
+
+EXTENSION = ".bin"
+MAGIC = b"KADDRIDE"
+VERSION = 2
+HEADER = struct.Struct('<8sHHHH')
+
+# File kinds
+KIND_IMU = 1
+KIND_GPS = 2
+
+# Record type tags, a tag of 0 is an unwritten (power loss) record
+TAG_IMU = 1
+TAG_GPS = 2
+TAG_NOFIX = 3
+TAG_ANCHOR = 4
+
+# Record flags
+FLAG_DID_ROLL = 0x01
+FLAG_ROLLOVER = 0x02
+# Anchor record flag, the wall clock was checked against GPS time
+FLAG_GPS_TIME = 0x04
+
+# Record layouts of each version, version 1 stored datetime64[us] times
+def recordDtypes(timeType):
+    return {
+        KIND_IMU: np.dtype([('tag', 'u1'), ('flags', 'u1'), ('time', timeType),
+                            ('accelX', 'f4'), ('accelY', 'f4'), ('accelZ', 'f4'),
+                            ('gyroX', 'f4'), ('gyroY', 'f4'), ('gyroZ', 'f4')]),
+        KIND_GPS: np.dtype([('tag', 'u1'), ('flags', 'u1'), ('sats', 'u2'), ('time', timeType),
+                            ('lat', 'f4'), ('long', 'f4'), ('vel', 'f4'), ('alt', 'f4'),
+                            ('accelX', 'f4'), ('accelY', 'f4'), ('accelZ', 'f4')])
+    }
+
+VERSION_DTYPES = {1: recordDtypes('M8[us]'), 2: recordDtypes('i8')}
+DTYPES = VERSION_DTYPES[VERSION]
+IMU_DTYPE = DTYPES[KIND_IMU]
+GPS_DTYPE = DTYPES[KIND_GPS]
+IMU_RECORD = struct.Struct('<BBq6f')
+GPS_RECORD = struct.Struct('<BBHq7f')
+
+# .csv columns of each kind, matching the headers written by sensors.py
+CSV_COLUMNS = {
+    KIND_IMU: ('time', 'accelX', 'accelY', 'accelZ', 'gyroX', 'gyroY', 'gyroZ', 'possibleRoll', 'rollover'),
+    KIND_GPS: ('time', 'lat', 'long', 'vel', 'alt', 'sats', 'accelX', 'accelY', 'accelZ', 'possibleRoll', 'rollover')
+}
+
+# Returns the header for a new file of kind
+def header(kind):
+    return HEADER.pack(MAGIC, VERSION, kind, DTYPES[kind].itemsize, 0)
+
+# Returns the flags byte for an IMU sample dictionary
+def sampleFlags(sample):
+    return (FLAG_DID_ROLL if sample["didRoll"] else 0) | (FLAG_ROLLOVER if sample["rollover"] else 0)
+
+# Packs an anchor record for a file of kind
+#
+# @offset: nanoseconds added to the monotonic times that follow to get unix time (clock.wallAnchor.offset)
+# @fromGps: True if the offset was checked against GPS time
+def packAnchor(kind, offset, fromGps):
+    flags = FLAG_GPS_TIME if fromGps else 0
+    if kind == KIND_IMU:
+        return IMU_RECORD.pack(TAG_ANCHOR, flags, offset, 0, 0, 0, 0, 0, 0)
+    return GPS_RECORD.pack(TAG_ANCHOR, flags, 0, offset, 0, 0, 0, 0, 0, 0, 0)
+
+# Packs an IMU sample dictionary into an IMU record
+def packImu(sample):
+    return IMU_RECORD.pack(TAG_IMU, sampleFlags(sample), sample["time"],
+                           sample["accelX"], sample["accelY"], sample["accelZ"],
+                           sample["gyroX"], sample["gyroY"], sample["gyroZ"])
+
+# Packs a GPS sample and its corresponding IMU sample into a GPS record
+# If either is missing a no fix record is packed
+def packGps(gpsSample, imuSample):
+    if not (gpsSample and imuSample):
+        return GPS_RECORD.pack(TAG_NOFIX, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0)
+    return GPS_RECORD.pack(TAG_GPS, sampleFlags(imuSample), gpsSample["sats"], gpsSample["time"],
+                           gpsSample["lat"], gpsSample["long"], gpsSample["speed"], gpsSample["alt"],
+                           imuSample["accelX"], imuSample["accelY"], imuSample["accelZ"])
+
+# Converts a window of ringBuffer samples into IMU records with a few array operations
+#
+# @window: structured array using ringBuffer.IMU_DTYPE
+# Returns the records as bytes
+def packImuWindow(window):
+    records = np.zeros(len(window), dtype=IMU_DTYPE)
+    records['tag'] = TAG_IMU
+    records['flags'] = np.where(window['didRoll'], FLAG_DID_ROLL, 0) | np.where(window['rollover'], FLAG_ROLLOVER, 0)
+    records['time'] = window['time']
+    for field in ringBuffer.IMU_FIELDS:
+        records[field] = window[field]
+    return records.tobytes()
+
+# Memory maps a ride file
+#
+# @fn: path to a binary ride file
+# Returns a tuple of (kind, structured array view of every complete record)
+def load(fn):
+    with open(fn, 'rb') as f:
+        magic, version, kind, recordSize, _ = HEADER.unpack(f.read(HEADER.size))
+    dtypes = VERSION_DTYPES.get(version, {})
+    if magic != MAGIC or kind not in dtypes or recordSize != dtypes[kind].itemsize:
+        raise ValueError(f"{fn} is not a version {' or '.join(map(str, VERSION_DTYPES))} ride file")
+
+    # Ignore a record that was only partially written
+    count = (os.path.getsize(fn) - HEADER.size) // recordSize
+    if count == 0:
+        return kind, np.zeros(0, dtype=dtypes[kind])
+    return kind, np.memmap(fn, dtype=dtypes[kind], mode='r', offset=HEADER.size, shape=(count,))
+
+# Converts the times of every record of a file to UTC
+# A single addition of the last anchor's offset, no per record work
+#
+# @records: every record of a file, as returned by load
+# Returns a datetime64[us] array (version 1 times are returned as they were written)
+def utcTimes(records):
+    if records.dtype['time'].kind == 'M':
+        return records['time'].astype('M8[us]')
+    anchors = np.flatnonzero(records['tag'] == TAG_ANCHOR)
+    offset = records['time'][anchors[-1]] if len(anchors) else 0
+    return ((records['time'] + offset) // 1000).astype('M8[us]')
+
+# Converts the records of a ride file into the same columns the .csv parser returns
+#
+# @fn: path to a binary ride file
+# @names: .csv header names of the columns to return
+# Returns a dictionary of header name -> list of values
+def readColumns(fn, names):
+    kind, records = load(fn)
+    # Skip no fix and anchor records and records zeroed by a power loss
+    keep = records['tag'] == (TAG_IMU if kind == KIND_IMU else TAG_GPS)
+    times = utcTimes(records)[keep] if 'time' in names else None
+    records = records[keep]
+
+    res = {}
+    for name in names:
+        if name == 'time':
+            res[name] = times.tolist()
+        elif name == 'possibleRoll':
+            res[name] = np.where(records['flags'] & FLAG_DID_ROLL, 'True', 'False').tolist()
+        elif name == 'rollover':
+            res[name] = np.where(records['flags'] & FLAG_ROLLOVER, 'True', 'False').tolist()
+        elif name in records.dtype.names:
+            # Samples are rounded to 5 decimals by sensors.py, undo the float32 representation error
+            res[name] = np.round(records[name].astype(np.float64), 5).tolist()
+        else:
+            res[name] = []
+    return res
+
+# Converts a binary ride file to the .csv layout written by sensors.py
+#
+# @fn: path to a binary ride file
+# @csvFn: path of the .csv to write
+def toCsv(fn, csvFn):
+    kind, records = load(fn)
+    keep = (records['tag'] != 0) & (records['tag'] != TAG_ANCHOR)
+    times = utcTimes(records)[keep]
+    records = records[keep]
+
+    columns = CSV_COLUMNS[kind]
+    table = np.zeros(len(records), dtype=[(name, 'M8[us]' if name == 'time' else
+                                           '?' if name in ('possibleRoll', 'rollover') else
+                                           'u2' if name == 'sats' else 'f4') for name in columns])
+    for name in columns:
+        if name == 'possibleRoll':
+            table[name] = records['flags'] & FLAG_DID_ROLL
+        elif name == 'rollover':
+            table[name] = records['flags'] & FLAG_ROLLOVER
+        elif name == 'time':
+            table[name] = times
+        else:
+            table[name] = records[name]
+
+    lines = ringBuffer.windowToLines(table)
+    if kind == KIND_GPS:
+        lines = np.where(records['tag'] == TAG_NOFIX, ','.join(['null'] * len(columns)), lines)
+
+    with open(csvFn, 'w') as outFile:
+        outFile.write(','.join(columns) + '\n')
+        if len(lines):
+            outFile.write('\n'.join(lines.tolist()) + '\n')
+
+if __name__ == "__main__":
+    for fn in sys.argv[1:]:
+        csvFn = os.path.splitext(fn)[0] + '.csv'
+        toCsv(fn, csvFn)
+        print(f"{fn} -> {csvFn}")
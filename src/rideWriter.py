@@ -0,0 +1,100 @@
+#!/usr/bin/python3
+import os
+import os.path
+import time
+
+# fsync policies for a rideWriter
+# never: leave it to the OS to write buffers out to the SD card
+# flush: fsync every time the in-memory batch is flushed
+# always: flush and fsync after every row (slowest, nothing is lost on power loss)
+FSYNC_NEVER = "never"
+FSYNC_FLUSH = "flush"
+FSYNC_ALWAYS = "always"
+
+# Class that keeps a ride file open for the length of a ride
+#
+# Initilization takes the file path, the header to write if the file is new
+# (bytes for a binary file, see rideFormat, or a string for a text file),
+# the number of rows to batch in memory, the maximum number of seconds a row
+# may sit in memory, and the fsync policy
+# The file is not created until the first row is flushed
+# Add rows with write, rows are flushed once maxRows or maxDelay is reached
+# Replace the contents of the file with rewrite
+# Must be closed with close to write out any remaining rows
+class rideWriter:
+    def __init__(self, fn, header, maxRows=32, maxDelay=5.0, fsync=FSYNC_FLUSH):
+        self.fn = fn
+        self.header = header
+        self.maxRows = max(1, int(maxRows))
+        self.maxDelay = maxDelay
+        self.fsync = fsync
+        self.rows = []
+        self.outFile = None
+        self.lastFlush = time.monotonic()
+        self.binary = isinstance(header, bytes)
+        self.mode = "ab" if self.binary else "a"
+        # Empty str or bytes used to join rows
+        self.empty = header[:0]
+        # Offset of the last time anchor record written to a binary file, see sensors.writeAnchor
+        self.anchor = None
+
+    # Opens the file for appending, writing the header if the file is new
+    # (or empty from a previous power loss)
+    def _open(self):
+        newFile = not os.path.exists(self.fn) or os.path.getsize(self.fn) == 0
+        self.outFile = open(self.fn, self.mode)
+        if newFile:
+            self.rows.insert(0, self.header)
+
+    # Queues a single row (including newline for a text file) to be written to the file
+    #
+    # @row: string or bytes to write
+    def write(self, row):
+        self.rows.append(row)
+        if self.fsync == FSYNC_ALWAYS or len(self.rows) >= self.maxRows \
+                or time.monotonic() - self.lastFlush >= self.maxDelay:
+            self.flush()
+
+    # Queues a block of rows (already joined) as a single write
+    #
+    # @block: string or bytes containing one or more rows
+    def writeBlock(self, block):
+        self.rows.append(block)
+        self.flush()
+
+    # Writes any rows held in memory out to the file
+    def flush(self):
+        if self.outFile is None:
+            if not self.rows:
+                return
+            self._open()
+        if self.rows:
+            self.outFile.write(self.empty.join(self.rows))
+            self.rows = []
+        self.outFile.flush()
+        if self.fsync != FSYNC_NEVER:
+            os.fsync(self.outFile.fileno())
+        self.lastFlush = time.monotonic()
+
+    # Flushes the writer if rows have been waiting longer than maxDelay
+    # Lets an idle loop push out rows without writing a new one
+    def tick(self):
+        if self.rows and time.monotonic() - self.lastFlush >= self.maxDelay:
+            self.flush()
+
+    # Replaces the contents of the file with the header followed by block
+    #
+    # @block: string or bytes containing the new rows of the file
+    def rewrite(self, block):
+        if self.outFile is None:
+            self.outFile = open(self.fn, self.mode)
+        self.outFile.seek(0)
+        self.outFile.truncate()
+        self.rows = [self.header, block]
+        self.flush()
+
+    def close(self):
+        self.flush()
+        if self.outFile is not None:
+            self.outFile.close()
+            self.outFile = None
@@ -0,0 +1,109 @@
+#!/usr/bin/python3
+import numpy as np
+
+# IMU channels stored in the ring buffer, in .csv column order
+IMU_FIELDS = ('accelX', 'accelY', 'accelZ', 'gyroX', 'gyroY', 'gyroZ')
+# Layout of one IMU sample, one field per channel, time is monotonic nanoseconds (clock.monotonicNs)
+IMU_DTYPE = np.dtype([('time', 'i8')] + [(field, 'f8') for field in IMU_FIELDS]
+                     + [('didRoll', '?'), ('rollover', '?')])
+# Layout of IMU samples with UTC times, for writing out as .csv
+IMU_UTC_DTYPE = np.dtype([('time', 'M8[us]')] + IMU_DTYPE.descr[1:])
+
+# Class that creates a cyclical array of IMU samples
+#
+# Initilization takes the maximum size (int) as a parameter
+# The samples live in a preallocated structured array twice the maximum size,
+# every sample is written to both halves so the last maxLen samples are always
+# a contiguous slice and can be returned in order without copying
+# Add samples (dicts with a key for every field of dtype) with append
+# Iterable; iterates through array contents from oldest to newest
+# Get the samples in order with window, or as .csv rows with toCsv
+# Get the last element in the array with getEnd, change it with setEnd
+class cyclicalArray:
+    def __init__(self, maxLen, dtype=IMU_DTYPE):
+        self.maxLen = maxLen
+        self.names = dtype.names
+        self.data = np.zeros(2 * maxLen, dtype=dtype)
+        self.endIndex = 0
+        self.size = 0
+    def __iter__(self):
+        return iter(self.window())
+    def __len__(self):
+        return self.length()
+    def append(self, val):
+        self.appendRow(tuple(val[name] for name in self.names))
+    # Adds a sample given as a tuple in dtype field order
+    def appendRow(self, row):
+        self.data[self.endIndex] = row
+        self.data[self.endIndex + self.maxLen] = row
+        self.endIndex = (self.endIndex + 1) % self.maxLen
+        self.size = self.size + 1
+    def clear(self):
+        self.endIndex = 0
+        self.size = 0
+    def display(self):
+        print(self.window())
+    def length(self):
+        return min(self.size, self.maxLen)
+    # Returns a view of the stored samples ordered from oldest to newest
+    def window(self):
+        if self.size < self.maxLen:
+            return self.data[:self.size]
+        return self.data[self.endIndex:self.endIndex + self.maxLen]
+    def getEnd(self):
+        return self.window()[-1]
+    # Sets field of the most recent sample to value
+    def setEnd(self, field, value):
+        last = (self.endIndex - 1) % self.maxLen
+        self.data[field][last] = value
+        self.data[field][last + self.maxLen] = value
+    # Returns the stored samples as .csv rows (without header), oldest first
+    def toCsv(self):
+        return windowToCsv(self.window())
+
+# Converts the monotonic times of an array of samples to UTC
+#
+# @window: structured array of samples (IMU_DTYPE)
+# @offset: nanoseconds to add to get unix time (clock.wallAnchor.offset)
+#
+# Returns a copy using IMU_UTC_DTYPE
+def utcWindow(window, offset):
+    table = np.zeros(len(window), dtype=IMU_UTC_DTYPE)
+    for name in IMU_DTYPE.names[1:]:
+        table[name] = window[name]
+    table['time'] = ((window['time'] + offset) // 1000).astype('M8[us]')
+    return table
+
+# Formats an array of samples as .csv rows in the order of its fields
+#
+# @window: structured array of samples
+#
+# Returns a string containing one line per sample
+def windowToCsv(window):
+    if len(window) == 0:
+        return ""
+    return "\n".join(windowToLines(window).tolist()) + "\n"
+
+# Formats an array of samples as .csv lines (without newlines) in the order of its fields
+# Every column is converted at once rather than formatting each row
+#
+# @window: structured array of samples
+#
+# Returns an array of strings, one per sample
+def windowToLines(window):
+    columns = []
+    for name in window.dtype.names:
+        column = window[name]
+        if column.dtype.kind == 'M':
+            # Matches str(datetime.datetime)
+            column = np.char.replace(np.datetime_as_string(column, unit='us'), 'T', ' ')
+        elif column.dtype.kind == 'b':
+            column = np.where(column, 'True', 'False')
+        else:
+            column = column.astype(str)
+        columns.append(column)
+
+    lines = columns[0]
+    for column in columns[1:]:
+        lines = np.char.add(np.char.add(lines, ','), column)
+    return lines
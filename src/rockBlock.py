@@ -173,13 +173,14 @@ class rockBlock(object):
                 return 0;
                       
                             
-    def sendMessage(self, msg):
+    #checkConnection = False skips waiting for network time and signal, for callers that already know them
+    def sendMessage(self, msg, checkConnection=True):
         self._ensureConnectionStatus()
                 
         if(self.callback != None and callable(self.callback.rockBlockTxStarted) ):
             self.callback.rockBlockTxStarted()
         
-        if( self._queueMessage(msg) and self._attemptConnection()  ):
+        if( self._queueMessage(msg) and (not checkConnection or self._attemptConnection())  ):
         
             SESSION_DELAY = 1
             SESSION_ATTEMPTS = 3
@@ -309,6 +310,11 @@ class rockBlock(object):
     #Private Methods - Don't call these directly!
     def _queueMessage(self, msg):
         self._ensureConnectionStatus()
+        
+        #Binary messages are sent as is, text as ASCII
+        if( isinstance(msg, str) ):
+            
+            msg = msg.encode("ascii")
                 
         if( len(msg) > 340):
                
@@ -326,17 +332,10 @@ class rockBlock(object):
            
             if(self.s.readline().strip().decode() == "READY"):
                 
-                checksum = 0
-                
-                for c in msg:
-                    
-                    checksum = checksum + ord(c)
-                
-                                
-                self.s.write( str.encode(str(msg)) )
+                #Checksum is the least significant 2 bytes of the sum of the message bytes
+                checksum = sum(msg) & 0xFFFF
                 
-                self.s.write( str.encode(chr( checksum >> 8 )) )
-                self.s.write( str.encode(chr( checksum & 0xFF )) )
+                self.s.write( msg + bytes( [checksum >> 8, checksum & 0xFF] ) )
                                        
                 self.s.readline().strip()   #BLANK
                 
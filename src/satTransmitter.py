@@ -0,0 +1,138 @@
+#!/usr/bin/python3
+import queue
+import datetime
+import threading
+import traceback
+import rockBlock
+import diag
+
+ERR_LOG = "/home/pi/kadd-pi/data/errorLog.txt"
+
+# Number of messages waiting to be sent before the oldest is dropped
+QUEUE_SIZE = 16
+
+# rockBlockProtocol handed to the RockBLOCK for one attempt
+# Records whether the attempt failed and passes every event on to callback
+class txRelay(rockBlock.rockBlockProtocol):
+    def __init__(self, callback):
+        self.callback = callback
+        self.failed = False
+
+    def forward(self, event, *args):
+        handler = getattr(self.callback, event, None)
+        if callable(handler):
+            handler(*args)
+
+    def rockBlockConnected(self):
+        self.forward("rockBlockConnected")
+    def rockBlockDisconnected(self):
+        self.forward("rockBlockDisconnected")
+    def rockBlockSignalUpdate(self, signal):
+        self.forward("rockBlockSignalUpdate", signal)
+    def rockBlockSignalPass(self):
+        self.forward("rockBlockSignalPass")
+    def rockBlockSignalFail(self):
+        self.forward("rockBlockSignalFail")
+    def rockBlockRxStarted(self):
+        self.forward("rockBlockRxStarted")
+    def rockBlockRxFailed(self):
+        self.forward("rockBlockRxFailed")
+    def rockBlockRxReceived(self, mtmsn, data):
+        self.forward("rockBlockRxReceived", mtmsn, data)
+    def rockBlockRxMessageQueue(self, count):
+        self.forward("rockBlockRxMessageQueue", count)
+    def rockBlockTxStarted(self):
+        self.forward("rockBlockTxStarted")
+    def rockBlockTxFailed(self):
+        self.failed = True
+        self.forward("rockBlockTxFailed")
+    def rockBlockTxSuccess(self, momsn):
+        self.forward("rockBlockTxSuccess", momsn)
+
+# Thread that sends queued messages over the RockBLOCK so sampling never waits on the satellite link
+#
+# Initilization takes an rbSession and the retryPolicy used for each message
+# The session is opened as soon as the thread starts and its network time and signal
+# state are refreshed whenever no message is waiting, so a message is sent on an
+# already configured modem
+# post queues a message (str or bytes) with the rockBlockProtocol its events are reported to,
+# and returns immediately, messages are sent oldest first
+# If the queue is full the oldest message is dropped (and counted in dropped)
+# sent and failed count the messages delivered and given up on
+class satTransmitter(threading.Thread):
+    def __init__(self, session, policy, queueSize=QUEUE_SIZE):
+        threading.Thread.__init__(self, name="satTransmitter", daemon=True)
+        self.session = session
+        self.policy = policy
+        self.messages = queue.Queue(maxsize=queueSize)
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+        self.stopped = threading.Event()
+
+    # Queues content to be sent
+    #
+    # @content: message to send
+    # @callback: rockBlockProtocol that gets the events of every attempt (or None)
+    def post(self, content, callback=None):
+        message = (content, callback)
+        try:
+            self.messages.put_nowait(message)
+        except queue.Full:
+            try:
+                self.messages.get_nowait()
+            except queue.Empty:
+                pass
+            self.messages.put_nowait(message)
+            self.dropped += 1
+
+    # Returns the number of messages waiting to be sent
+    def pending(self):
+        return self.messages.qsize()
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                content, callback = self.messages.get(timeout=min(1.0, self.session.untilRefresh()))
+            except queue.Empty:
+                if self.session.untilRefresh() <= 0:
+                    self.refresh()
+                continue
+            try:
+                self.policy.call(self.sendOnce, content, callback, onFailure=self.logFailure)
+                self.sent += 1
+            except Exception:
+                self.failed += 1
+
+    # Updates the session's cached network time and signal state
+    def refresh(self):
+        try:
+            ready = self.session.refresh()
+            diag.debug("RockBLOCK signal {}, network time {}", self.session.signal,
+                       "valid" if self.session.timeValid else "invalid")
+            if not ready:
+                diag.info("RockBLOCK not ready to send, signal {}", self.session.signal)
+        except Exception as exc:
+            diag.warn("Unable to reach the RockBLOCK: {}", repr(exc))
+
+    # Makes one attempt at sending content
+    # Raises rockBlockException if the message wasn't sent
+    def sendOnce(self, content, callback):
+        relay = txRelay(callback)
+        if not self.session.send(content, relay) or relay.failed:
+            self.session.invalidate()
+            raise rockBlock.rockBlockException("Message not sent")
+
+    def logFailure(self, exc, attempt, delay):
+        with open(ERR_LOG, "a") as errorLog:
+            errorLog.write(str(datetime.datetime.now())+"\n")
+            if delay is None:
+                errorLog.write(f"Giving up sending message after {attempt} attempts.\n")
+            else:
+                errorLog.write(f"Attempt {attempt} sending message failed, retrying in {delay:.1f} seconds.\n")
+            traceback.print_tb(exc.__traceback__, file=errorLog)
+        if delay is None:
+            diag.error("Giving up sending message after {} attempts", attempt)
+
+    def stop(self):
+        self.stopped.set()
@@ -0,0 +1,127 @@
+#!/usr/bin/python3
+# Packed binary emergency messages sent over the RockBLOCK (Iridium SBD)
+#
+# Iridium bills a message per 50 byte credit, a message is 28 bytes (38 with the
+# IMU summary) against about 40 for the text "PHONE,long,lat,DEV_ID"
+# All fields are big endian
+#   version     u1   VERSION
+#   flags       u1   FLAG_* bits
+#   device      u4   crc32 of the device ID
+#   time        u4   unix time of the alert (seconds)
+#   latitude    i4   degrees * COORD_SCALE
+#   longitude   i4   degrees * COORD_SCALE
+#   fixAge      u2   seconds between the GPS fix and the alert, NO_FIX_AGE without a fix
+#   phone       u8   phone number to notify (0 = Noonlight service)
+# followed, if FLAG_IMU is set, by a summary of the recent IMU samples
+#   peakAccel   u2   largest acceleration magnitude * IMU_SCALE (m/s^2)
+#   peakGyro    u2   largest rotation rate magnitude * IMU_SCALE (rad/s)
+#   meanAccelX  i2   mean acceleration on each axis * IMU_SCALE (m/s^2)
+#   meanAccelY  i2
+#   meanAccelZ  i2
+#
+# Usage: python3 sbdMessage.py <message as hex>
+import sys
+import time
+import zlib
+import struct
+import datetime
+import numpy as np
+
+VERSION = 1
+HEADER = struct.Struct('>BBIIiiHQ')
+IMU_SUMMARY = struct.Struct('>HHhhh')
+
+FLAG_FIX = 1
+FLAG_ROLLOVER = 2
+FLAG_IMU = 4
+
+# Fixed point scale of coordinates, 1e-7 degrees is about 1cm
+COORD_SCALE = 10_000_000
+# Fixed point scale of IMU summary values
+IMU_SCALE = 100
+NO_FIX_AGE = 0xFFFF
+
+# Returns the 32 bit hash of a device ID sent in place of the ID
+def deviceHash(devId):
+    return zlib.crc32(str(devId).encode())
+
+# Clamps value to the range of a fixed point field
+def clamp(value, low, high):
+    return int(max(low, min(high, round(value))))
+
+# Summarises recent IMU samples
+#
+# @window: structured array of IMU samples (ringBuffer.IMU_DTYPE)
+# Returns the packed summary bytes, or empty bytes if window is empty
+def packImuSummary(window):
+    if len(window) == 0:
+        return b""
+    accel = np.column_stack((window['accelX'], window['accelY'], window['accelZ']))
+    gyro = np.column_stack((window['gyroX'], window['gyroY'], window['gyroZ']))
+    peakAccel = np.sqrt((accel ** 2).sum(axis=1)).max() * IMU_SCALE
+    peakGyro = np.sqrt((gyro ** 2).sum(axis=1)).max() * IMU_SCALE
+    means = accel.mean(axis=0) * IMU_SCALE
+    return IMU_SUMMARY.pack(clamp(peakAccel, 0, 0xFFFF), clamp(peakGyro, 0, 0xFFFF),
+                            *(clamp(mean, -0x8000, 0x7FFF) for mean in means))
+
+# Packs an emergency message
+#
+# @phone: phone number to notify (0 = Noonlight service), anything but digits is ignored
+# @devId: device ID
+# @gps: GPS sample (dict with lat, long and time) or None without a fix
+# @rollover: True if the alert is a detected rollover, False for a keyfob press
+# @imuWindow: optional structured array of recent IMU samples to summarise
+# @now: unix time of the alert, defaults to the current time
+#
+# Returns the message as bytes
+def encode(phone, devId, gps, rollover, imuWindow=None, now=None):
+    if now is None:
+        now = time.time()
+    flags = FLAG_ROLLOVER if rollover else 0
+    lat, long, fixAge = 0, 0, NO_FIX_AGE
+    if gps is not None:
+        flags |= FLAG_FIX
+        lat = clamp(gps['lat'] * COORD_SCALE, -0x80000000, 0x7FFFFFFF)
+        long = clamp(gps['long'] * COORD_SCALE, -0x80000000, 0x7FFFFFFF)
+        fixAge = clamp(now - gps['time'].timestamp(), 0, NO_FIX_AGE - 1)
+
+    summary = b"" if imuWindow is None else packImuSummary(imuWindow)
+    if summary:
+        flags |= FLAG_IMU
+
+    digits = "".join(c for c in str(phone) if c.isdigit())
+    return HEADER.pack(VERSION, flags, deviceHash(devId), int(now), lat, long,
+                       fixAge, int(digits or 0)) + summary
+
+# Unpacks an emergency message
+#
+# @data: message bytes
+# Returns a dict of the message fields, coordinates in degrees (None without a fix)
+# Raises ValueError if data isn't a version VERSION message
+def decode(data):
+    if len(data) < HEADER.size or data[0] != VERSION:
+        raise ValueError("Not a version " + str(VERSION) + " emergency message")
+    version, flags, device, alertTime, lat, long, fixAge, phone = HEADER.unpack_from(data)
+    hasFix = bool(flags & FLAG_FIX)
+    message = {
+        'version': version,
+        'device': device,
+        'time': datetime.datetime.fromtimestamp(alertTime, datetime.timezone.utc),
+        'rollover': bool(flags & FLAG_ROLLOVER),
+        'lat': lat / COORD_SCALE if hasFix else None,
+        'long': long / COORD_SCALE if hasFix else None,
+        'fixAge': fixAge if hasFix else None,
+        'phone': phone
+    }
+    if flags & FLAG_IMU:
+        if len(data) < HEADER.size + IMU_SUMMARY.size:
+            raise ValueError("Emergency message IMU summary is truncated")
+        peakAccel, peakGyro, meanX, meanY, meanZ = IMU_SUMMARY.unpack_from(data, HEADER.size)
+        message['peakAccel'] = peakAccel / IMU_SCALE
+        message['peakGyro'] = peakGyro / IMU_SCALE
+        message['meanAccel'] = (meanX / IMU_SCALE, meanY / IMU_SCALE, meanZ / IMU_SCALE)
+    return message
+
+if __name__ == "__main__":
+    for arg in sys.argv[1:]:
+        print(decode(bytes.fromhex(arg)))
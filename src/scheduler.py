@@ -0,0 +1,130 @@
+#!/usr/bin/python3
+import threading
+import clock
+
+# Overrun policies for a task that missed one or more deadlines
+# skip: run once and move on to the next deadline in the future
+# catchup: run once for every missed deadline (up to maxCatchUp), keeps the task's average rate
+SKIP = "skip"
+CATCH_UP = "catchup"
+
+# Class representing a task run by taskScheduler
+#
+# @name: name used to trigger the task
+# @period: seconds between runs, None for a task that only runs when triggered
+# @phase: seconds after the scheduler starts that the first run is due
+# @fn: function called with no arguments when the task is due
+# @policy: overrun policy (SKIP or CATCH_UP)
+class task:
+    def __init__(self, name, period, phase, fn, policy):
+        self.name = name
+        self.period = period
+        self.phase = phase
+        self.fn = fn
+        self.policy = policy
+        self.nextRun = None
+        self.triggered = False
+        self.runs = 0
+        self.overruns = 0
+
+# Class that runs periodic tasks, sleeping until the next one is due
+#
+# Initilization takes the overrun policy used by tasks that don't set their own,
+# the maximum number of missed runs a CATCH_UP task makes up at once, and the clock
+# (a clock.realClock or clock.virtualClock) it reads the time and sleeps on
+# Add tasks with add, then call run (loops forever) or runPending
+# trigger makes a task due immediately and wakes the scheduler, it is safe to
+# call from other threads (e.g. a GPIO interrupt callback)
+class taskScheduler:
+    def __init__(self, policy=SKIP, maxCatchUp=5, clock=clock.REAL):
+        self.policy = policy
+        self.maxCatchUp = maxCatchUp
+        self.clock = clock.monotonic
+        self.wait = clock.wait
+        self.tasks = []
+        self.start = None
+        self.wakeEvent = threading.Event()
+        self.lock = threading.Lock()
+        self.stopped = False
+
+    # Adds a task to the scheduler
+    #
+    # Returns the created task
+    def add(self, name, period, fn, phase=0.0, policy=None):
+        newTask = task(name, period, phase, fn, policy or self.policy)
+        if self.start is not None and period is not None:
+            newTask.nextRun = self.clock() + phase
+        self.tasks.append(newTask)
+        return newTask
+
+    # Makes the task called name due now and wakes the scheduler
+    def trigger(self, name):
+        with self.lock:
+            for t in self.tasks:
+                if t.name == name:
+                    t.triggered = True
+        self.wakeEvent.set()
+
+    def stop(self):
+        self.stopped = True
+        self.wakeEvent.set()
+
+    # Returns the number of seconds until the next task is due (0 if one is due now)
+    def timeUntilNext(self):
+        now = self.clock()
+        delay = None
+        for t in self.tasks:
+            if t.triggered:
+                return 0.0
+            if t.nextRun is not None:
+                remaining = t.nextRun - now
+                if delay is None or remaining < delay:
+                    delay = remaining
+        if delay is None:
+            return None
+        return max(0.0, delay)
+
+    # Runs every task that is due
+    def runPending(self):
+        if self.start is None:
+            self.start = self.clock()
+            for t in self.tasks:
+                if t.period is not None:
+                    t.nextRun = self.start + t.phase
+
+        for t in self.tasks:
+            with self.lock:
+                triggered = t.triggered
+                t.triggered = False
+            now = self.clock()
+            due = t.nextRun is not None and now >= t.nextRun
+
+            if not due:
+                if triggered:
+                    t.fn()
+                    t.runs += 1
+                continue
+
+            # Number of deadlines that have passed, including the current one
+            missed = int((now - t.nextRun) // t.period) + 1
+            if missed > 1:
+                t.overruns += missed - 1
+
+            if t.policy == CATCH_UP:
+                runs = min(missed, self.maxCatchUp)
+            else:
+                runs = 1
+            for _ in range(runs):
+                t.fn()
+                t.runs += 1
+            # Stay on the task's grid so samples stay evenly spaced
+            t.nextRun += missed * t.period
+
+    # Runs tasks as they come due until stop is called
+    def run(self):
+        while not self.stopped:
+            self.runPending()
+            delay = self.timeUntilNext()
+            if delay is None or delay > 0:
+                self.wait(self.wakeEvent, delay)
+            self.wakeEvent.clear()
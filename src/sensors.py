@@ -1,31 +1,47 @@
 #!/usr/bin/python3
 import time
 import datetime
-import serial
 import os
 import os.path
-import json
-import adafruit_gps
-
-import board
-import busio
-import adafruit_lsm9ds1
-from digitalio import DigitalInOut, Direction
 
 import rockBlock
+import settings
+import diag
+import rideWriter
+import rideFormat
+import rideCounter
+import ringBuffer
+import scheduler
+import gpsReader
+import cone
+import crashCapture
+import sbdMessage
+import satTransmitter
+import rbSession
+import retry
+import clock
+import loopStats
+import orientation
 import math
+import numpy as np
 import traceback
+import threading
+import queue
 
 from xml.dom import minidom
-import RPi.GPIO as GPIO
 
-# File path to store .csv
+# File path to store ride files
 HISTORY = "/home/pi/kadd-pi/data/rideHistory.json"
 PATH = "/home/pi/kadd-pi/data/rides/current/"
 IMU_FULL_REC_PATH = "/home/pi/kadd-pi/data/rides/imuComplete/"
+CAPTURE_PATH = "/home/pi/kadd-pi/data/rides/captures/"
+STATS_PATH = "/home/pi/kadd-pi/data/rides/stats/"
 ERR_LOG = "/home/pi/kadd-pi/data/errorLog.txt"
 CONFIG = "/home/pi/kadd-pi/data/about.xml"
 
+IMU_HEADER = 'time,accelX,accelY,accelZ,gyroX,gyroY,gyroZ,possibleRoll,rollover\n'
+GPS_HEADER = 'time,lat,long,vel,alt,sats,accelX,accelY,accelZ,possibleRoll,rollover\n'
+
 if os.path.isfile(CONFIG):
     config = minidom.parse(CONFIG)
     MIN_ACCEL = float(config.getElementsByTagName('coneMinAccel')[0].firstChild.data)
@@ -35,6 +51,24 @@ if os.path.isfile(CONFIG):
     FOB_GPIO = int(config.getElementsByTagName('keyfobGpio')[0].firstChild.data)
     PHONE = str(config.getElementsByTagName('phone')[0].firstChild.data)
     DEV_ID = str(config.getElementsByTagName('devId')[0].firstChild.data)
+    WRITER_ROWS = settings.configValue(config, 'writerFlushRows', 32)
+    WRITER_DELAY = settings.configValue(config, 'writerFlushSecs', 5.0)
+    WRITER_FSYNC = settings.configValue(config, 'writerFsync', rideWriter.FSYNC_FLUSH)
+    HISTORY_FLUSH = settings.configValue(config, 'historyFlushSecs', 10.0)
+    SCHED_POLICY = settings.configValue(config, 'schedPolicy', scheduler.SKIP)
+    RIDE_FORMAT = settings.configValue(config, 'rideFormat', "bin")
+    LOG_LEVEL = settings.configValue(config, 'logLevel', "warn")
+    GPS_STALE = settings.configValue(config, 'gpsStaleSecs', 5.0)
+    GPS_FIX_RATE = settings.configValue(config, 'gpsFixRate', 0.0)
+    CAPTURE_RATE = settings.configValue(config, 'crashCaptureRate', 100.0)
+    CAPTURE_PRE = settings.configValue(config, 'crashCapturePreSecs', 10.0)
+    CAPTURE_POST = settings.configValue(config, 'crashCapturePostSecs', 5.0)
+    SBD_FORMAT = settings.configValue(config, 'sbdFormat', "bin")
+    LOOP_STATS_SECS = settings.configValue(config, 'loopStatsSecs', 60.0)
+    GPS_TIME_TOLERANCE = settings.configValue(config, 'gpsTimeToleranceSecs', 2.0)
+    ORIENTATION_RATE = settings.configValue(config, 'orientationRate', 50.0)
+    ORIENTATION_TAU = settings.configValue(config, 'orientationTimeConstant', 0.5)
+    ROLLOVER_HOLD = settings.configValue(config, 'rolloverHoldSecs', 0.5)
 else:
     # Minimum (largest negative) acceleration for z axis to be considered a steady-state
     # rollover, also z coordinate for tip of cone
@@ -53,57 +87,155 @@ else:
     PHONE = 0
     # Device ID
     DEV_ID = "default_device"
+    # Number of rows a ride file holds in memory before writing them out
+    WRITER_ROWS = 32
+    # Maximum number of seconds a row is held in memory before being written out
+    WRITER_DELAY = 5.0
+    # When ride files are fsynced to the SD card (never, flush, always)
+    WRITER_FSYNC = rideWriter.FSYNC_FLUSH
+    # Minimum number of seconds between writes of the ride history json
+    HISTORY_FLUSH = 10.0
+    # What the main loop does when a task misses its deadline (skip, catchup)
+    SCHED_POLICY = scheduler.SKIP
+    # Format ride files are written in (bin = rideFormat binary records, csv = text)
+    RIDE_FORMAT = "bin"
+    # Lowest level of console output printed (debug, info, warn, error, off)
+    LOG_LEVEL = "warn"
+    # Number of seconds after which the last GPS sentence is too old to count as a fix
+    GPS_STALE = 5.0
+    # GPS fixes per second, 0 derives it from the GPS sample rate
+    GPS_FIX_RATE = 0.0
+    # IMU samples per second kept for crash captures, 0 turns crash captures off
+    CAPTURE_RATE = 100.0
+    # Number of seconds of high rate IMU samples saved before and after a rollover
+    CAPTURE_PRE = 10.0
+    CAPTURE_POST = 5.0
+    # Format of emergency messages (bin = sbdMessage packed binary, text = "PHONE,long,lat,DEV_ID")
+    SBD_FORMAT = "bin"
+    # Seconds between snapshots of the sampling loop's timing histograms, 0 turns them off
+    LOOP_STATS_SECS = 60.0
+    # Seconds the system clock may differ from GPS time before ride times are re-anchored to GPS time
+    GPS_TIME_TOLERANCE = 2.0
+    # IMU readings per second fed to the orientation filter, 0 checks raw accelerometer samples against the cone
+    ORIENTATION_RATE = 50.0
+    # Seconds over which the orientation filter trusts the gyro before the accelerometer pulls it back
+    ORIENTATION_TAU = 0.5
+    # Seconds the filtered orientation must stay in the cone before an alert, 0 only alerts on crashTimerThreshold
+    ROLLOVER_HOLD = 0.5
+
+diag.setLevel(LOG_LEVEL)
 
-# Main cone coefficient
-CONE_COEFF = MIN_ACCEL/(MAX_ACCEL-MIN_ACCEL)
+# Rollover cone with its coefficients precomputed
+CONE = cone.rolloverCone(MIN_ACCEL, MAX_ACCEL, SENSITIVITY)
 # Conversion factor from knots to other units
 CONV = 1.852 #kph
+# Baud rate the GPS starts at after losing power
+GPS_DEFAULT_BAUD = 9600
+# Baud rates the GPS (PMTK251) supports
+GPS_BAUDS = (9600, 14400, 19200, 38400, 57600, 115200)
+# Spare link capacity kept when choosing a baud rate
+GPS_BAUD_MARGIN = 1.5
+# Fastest fix rate the GPS supports (hz)
+GPS_MAX_FIX_RATE = 10.0
+# Typical length in bytes of the GGA and RMC sentences
+GGA_BYTES = 80
+RMC_BYTES = 75
+# Bits sent on the UART per byte (start, 8 data, stop)
+BITS_PER_BYTE = 10
+# Seconds to look for a valid sentence when checking a baud rate
+GPS_PROBE_SECS = 2.0
+# Seconds for the GPS to switch baud rate after PMTK251
+GPS_SWITCH_DELAY = 0.5
 # Size of IMU data history stored in cyclical array
 IMU_SAMPLE_SIZE = 60
 # Imu refresh rate in seconds if farm mode is active
 FARM_IMU_RATE = 1.0
+# Number of IMU samples the acquisition thread can queue before the oldest are dropped
+IMU_QUEUE_SIZE = 256
+# Maximum number of missed runs a task catches up on at once
+SCHED_CATCH_UP = 5
+# Milliseconds to ignore further keyfob edges after a press
+FOB_BOUNCE = 200
+# Restarts of the sampling loop, every error but samplingStopped is retried (the device
+# must keep logging) with the delay growing to 30 seconds, a session that ran for a
+# minute starts the backoff over
+SAMPLING_RETRY = retry.retryPolicy("sampling", baseDelay=1.0, maxDelay=30.0,
+                                   classify=lambda exc: not isinstance(exc, samplingStopped), resetAfter=60.0)
+# Re-sends of an emergency message, given up after RB_RETRY_ATTEMPTS attempts
+RB_RETRY_ATTEMPTS = 10
+RB_RETRY = retry.retryPolicy("rockBlock", maxAttempts=RB_RETRY_ATTEMPTS, baseDelay=5.0, maxDelay=120.0)
+# Serial port of the RockBLOCK
+RB_PORT = "/dev/ttyUSB0"
 
-# Class that creates a cyclical array
-#
-# Initilization takes the maximum size (int) as a parameter
-# Add values with append
-# Iterable; iterates through array contents
-# Print contents with display
-# Get the last element in the array with getEnd
-class cyclicalArray:
-    data = []
-    endIndex = 0
-    maxLen = 0
-    size = 0
-    def __init__(self, maxLen):
-        self.maxLen = maxLen
-    def __iter__(self):
-        return iter(self.data)
-    def append(self, val):
-        if self.size < self.maxLen:
-            self.data.insert(self.endIndex, val)
-        else:
-            self.data[self.endIndex] = val
-        self.endIndex = (self.endIndex + 1) % self.maxLen
-        self.size = self.size + 1
-    def clear(self):
-        self.data = []
-        self.endIndex = 0
-        self.size = 0
-    def display(self):
-        print(self.data)
-    def length(self):
-        return len(self.data)
-    def getEnd(self):
-        if self.endIndex == 0:
-            return self.data[self.maxLen - 1]
-        else:
-            return self.data[self.endIndex - 1]
+# Satellite transmitter shared by every moMessage, created by getTransmitter
+transmitter = None
+transmitterLock = threading.Lock()
+
+# Raised by a sensor backend that has run out of data (e.g. the end of a replayed ride),
+# stops sampling instead of restarting it
+class samplingStopped(Exception):
+    pass
+
+# Sensor backend of the Pi: the LSM9DS1 on SPI, the GPS on /dev/ttyS0, the keyfob on
+# FOB_GPIO and the RockBLOCK, running on the system clock
+# The hardware libraries are only imported when a sensor is created, so the rest of
+# this module can run anywhere with a different backend (see replay.py) providing
+# the same methods and clock
+class hardwareBackend:
+    clock = clock.REAL
+
+    # Opens anything that should be ready before sampling starts
+    def start(self):
+        getTransmitter()
+
+    def createImu(self):
+        return createImu()
+
+    def createGps(self, sampleRate):
+        return createGps(sampleRate)
+
+    # Calls callback when the keyfob is pressed
+    # Runs before the IMU is created, so the pin numbering importing board used to set is set here
+    def watchKeyfob(self, callback):
+        import RPi.GPIO as GPIO
+        GPIO.setwarnings(False)
+        GPIO.setmode(GPIO.BCM)
+        GPIO.setup(FOB_GPIO, GPIO.IN, pull_up_down=GPIO.PUD_DOWN)
+        GPIO.remove_event_detect(FOB_GPIO)
+        GPIO.add_event_detect(FOB_GPIO, GPIO.RISING, callback=lambda channel: callback(),
+                              bouncetime=FOB_BOUNCE)
+
+    def unwatchKeyfob(self):
+        import RPi.GPIO as GPIO
+        GPIO.remove_event_detect(FOB_GPIO)
+
+    # Queues content to be sent over the RockBLOCK, events are reported to callback
+    def sendMessage(self, content, callback):
+        getTransmitter().post(content, callback)
+
+# Backend the sensors are read through and the clock sampling runs on, set with setBackend
+BACKEND = hardwareBackend()
+CLOCK = BACKEND.clock
+# Converts the monotonic timestamps of samples to UTC, one anchor for the life of the process
+# (monotonic time only holds within a boot), checked against GPS time on the first fix
+ANCHOR = clock.wallAnchor(CLOCK)
+
+# Sets the sensor backend startSampling uses
+def setBackend(backend):
+    global BACKEND, CLOCK, ANCHOR
+    BACKEND = backend
+    CLOCK = backend.clock
+    ANCHOR = clock.wallAnchor(CLOCK)
 
 # Creates a LSM9D1_SPI object to represent the device's IMU using SPI
 #
 # Returns a LSM9D1_SPI object
 def createImu():
+    import board
+    import busio
+    import adafruit_lsm9ds1
+    from digitalio import DigitalInOut, Direction
+
     #SPI connection:
     spi = busio.SPI(board.SCK, board.MOSI, board.MISO)
     csag = DigitalInOut(board.D5)
@@ -120,18 +252,25 @@ def createImu():
 #
 # Returns True if there was a rollover, False otherwise
 def detectRollover(sample):
-    # MAX_ACCEL <= z <= MIN_ACCEL
-    if sample["accelZ"] >= MIN_ACCEL and sample["accelZ"] <= MAX_ACCEL:
-        r = math.sqrt((CONE_COEFF*(sample["accelZ"]-MIN_ACCEL)*SENSITIVITY)**2)
-        distFromZ = math.sqrt((sample["accelX"]*sample["accelX"])+(sample["accelY"]*sample["accelY"]))
-        print(f"Radius of cone at height {sample['accelZ']}: {r}")
-        print(f"Point ({sample['accelX']},{sample['accelY']},{sample['accelZ']}) is {distFromZ} away from the z-axis")
-        if distFromZ <= r:
-            return True
-        else:
-            return False
-    
-    return False
+    return CONE.contains(sample["accelX"], sample["accelY"], sample["accelZ"])
+
+# Detects Rollover scenarios for a batch of samples at once, see detectRollover
+#
+# @accel: array of shape (n, 3) holding (accelX, accelY, accelZ) rows
+#
+# Returns a boolean array of length n, True where there was a rollover
+def detectRolloverBatch(accel):
+    return CONE.mask(accel)
+
+# Sets didRoll on a batch of IMU samples with a single detectRolloverBatch call
+#
+# @samples: list of IMU sample dictionaries
+def classifyImuSamples(samples):
+    if not samples:
+        return
+    accel = np.array([(sample["accelX"], sample["accelY"], sample["accelZ"]) for sample in samples])
+    for sample, didRoll in zip(samples, detectRolloverBatch(accel).tolist()):
+        sample["didRoll"] = didRoll
 
 # Updates the number of seconds a vehicle has been rolled over
 #
@@ -148,7 +287,8 @@ def updateRollCount(rollCount, sample):
 # Takes a sample of the IMU's accelerometer and gyroscope
 #
 # @imu: IMU instance representing the sensor to be sampled
-# returns dicitonary including accel and gyro data for all 3 axis and didRoll if roll was detected
+# returns dicitonary including accel and gyro data for all 3 axis and didRoll,
+# didRoll is left False and set in batches by classifyImuSamples
 def sampleImu(imu):
     accelX, accelY, accelZ = imu.acceleration
     gyroX, gyroY, gyroZ = imu.gyro
@@ -156,11 +296,10 @@ def sampleImu(imu):
     accelX, accelY, accelZ = round(accelX, 5), round(accelY, 5), round(accelZ,5)
     gyroX, gyroY, gyroZ = round(gyroX, 5), round(gyroY, 5), round(gyroZ,5)
 
-    print('Accel (x,y,z): ' + f'{accelX}' + "," + f'{accelY}' + "," + f'{accelZ}' + '\n' \
-          + 'Gyro (x,y,z): ' + f'{gyroX}' + "," + f'{gyroY}' + "," + f'{gyroZ}' + '\n')
+    diag.debug('Accel (x,y,z): {},{},{}\nGyro (x,y,z): {},{},{}\n', accelX, accelY, accelZ, gyroX, gyroY, gyroZ)
 
     sample = {
-        'time': datetime.datetime.now(),
+        'time': CLOCK.monotonicNs(),
         'accelX': accelX,
         'accelY': accelY,
         'accelZ': accelZ,
@@ -171,82 +310,361 @@ def sampleImu(imu):
         'rollover': False
     }
 
-    sample['didRoll'] = detectRollover(sample)
     return sample
 
-# Writes an array of IMU samples out to a file path called fn
+# Reads the IMU without rounding or console output, for high rate crash captures
+#
+# @imu: LSM9DS1 object
+# Returns a tuple in ringBuffer.IMU_DTYPE field order
+def readImuRow(imu):
+    accelX, accelY, accelZ = imu.acceleration
+    gyroX, gyroY, gyroZ = imu.gyro
+    return (CLOCK.monotonicNs(), accelX, accelY, accelZ, gyroX, gyroY, gyroZ, False, False)
+
+# Thread that samples the IMU at a fixed rate, independent of the GPS and file I/O
+#
+# Initilization takes the IMU instance, the number of seconds between samples,
+# the maximum number of samples held in the queue, an optional crashCapture,
+# optional loopStats the read times and sample jitter are recorded in, an optional
+# orientation.orientationFilter with the readings per second it is updated at, and
+# a function called (on this thread) when the filtered orientation has been rolled
+# over for ROLLOVER_HOLD seconds
+# Samples are pushed to the bounded queue samples, if the consumer falls behind
+# the oldest sample is dropped (and counted in dropped) to keep the newest
+# The most recent sample is also kept in latest
+# With a crashCapture or orientation filter the IMU is read at the faster of their
+# rates, every reading is added to the capture and the filter, the queue still only
+# gets one sample every rate seconds
+# With a filter, didRoll of each sample is the filtered orientation checked against
+# the cone, and the sample carries the roll and pitch (degrees) of the estimate
+# If sampling fails the exception is stored in error and the thread stops
+class imuSampler(threading.Thread):
+    def __init__(self, imu, rate, queueSize=IMU_QUEUE_SIZE, capture=None, stats=None,
+                 orientation=None, orientationRate=ORIENTATION_RATE, onRollover=None):
+        threading.Thread.__init__(self, name="imuSampler", daemon=True)
+        self.imu = imu
+        self.rate = rate
+        self.capture = capture
+        self.stats = stats
+        self.orientation = orientation
+        self.orientationRate = orientationRate
+        self.onRollover = onRollover
+        self.rolledSince = None
+        self.rolledOver = False
+        self.samples = queue.Queue(maxsize=queueSize)
+        self.latest = None
+        self.dropped = 0
+        self.error = None
+        self.stopped = threading.Event()
+
+    def run(self):
+        period = self.rate
+        if self.capture is not None:
+            period = min(period, self.capture.period)
+        if self.orientation is not None:
+            period = min(period, 1.0 / self.orientationRate)
+        nextTick = nextSample = CLOCK.monotonic()
+        try:
+            while not self.stopped.is_set():
+                start = CLOCK.monotonic()
+                readStart = self.stats.timer() if self.stats is not None else None
+                if nextTick >= nextSample - period / 2:
+                    sample = sampleImu(self.imu)
+                    if self.stats is not None:
+                        self.stats.lap("imuRead", readStart)
+                        self.stats.interval("imuSample", self.rate, start)
+                    row = tuple(sample[name] for name in ringBuffer.IMU_DTYPE.names)
+                    if self.orientation is not None:
+                        self.updateOrientation(start, row, sample)
+                    self.publish(sample)
+                    nextSample = max(nextSample + self.rate, nextTick + self.rate - period / 2)
+                else:
+                    row = readImuRow(self.imu)
+                    if self.orientation is not None:
+                        self.updateOrientation(start, row)
+                    if self.stats is not None:
+                        self.stats.lap("fastRead", readStart)
+                if self.capture is not None:
+                    self.capture.add(row)
+                if self.stats is not None and period < self.rate:
+                    self.stats.interval("fastSample", period, start)
+
+                # Sample on a fixed grid, if a sample overran start a new grid from now
+                nextTick += period
+                delay = nextTick - CLOCK.monotonic()
+                if delay > 0:
+                    CLOCK.wait(self.stopped, delay)
+                else:
+                    nextTick = CLOCK.monotonic()
+        except Exception as exc:
+            self.error = exc
+
+    # Feeds a reading to the orientation filter and tracks how long it has been rolled over
+    #
+    # @t: monotonic time of the reading
+    # @row: reading as a tuple in ringBuffer.IMU_DTYPE field order
+    # @sample: sample dictionary to store the estimate in, if the reading is a queued sample
+    def updateOrientation(self, t, row, sample=None):
+        roll, pitch = self.orientation.update(t, *row[1:7])
+        rolled = CONE.contains(*self.orientation.gravity())
+        if sample is not None:
+            sample['didRoll'] = rolled
+            sample['roll'] = math.degrees(roll)
+            sample['pitch'] = math.degrees(pitch)
+        if not rolled:
+            self.rolledSince = None
+            self.rolledOver = False
+        elif self.rolledSince is None:
+            self.rolledSince = t
+        elif not self.rolledOver and ROLLOVER_HOLD > 0 and t - self.rolledSince >= ROLLOVER_HOLD:
+            self.rolledOver = True
+            if self.onRollover is not None:
+                self.onRollover()
+
+    # Queues a sample for the main loop, dropping the oldest if the queue is full
+    def publish(self, sample):
+        self.latest = sample
+        try:
+            self.samples.put_nowait(sample)
+        except queue.Full:
+            try:
+                self.samples.get_nowait()
+            except queue.Empty:
+                pass
+            self.samples.put_nowait(sample)
+            self.dropped += 1
+
+    # Returns a list of every sample queued since the last call
+    def drain(self):
+        samples = []
+        try:
+            while True:
+                samples.append(self.samples.get_nowait())
+        except queue.Empty:
+            pass
+        return samples
+
+    def stop(self):
+        self.stopped.set()
+
+# Creates a rideWriter for a ride file using the configured file format, flush and fsync policy
+#
+# @fn: file path to output to, without extension
+# @kind: rideFormat.KIND_IMU or rideFormat.KIND_GPS
+#
+# Returns a rideWriter object
+def createWriter(fn, kind):
+    if RIDE_FORMAT == "bin":
+        fn, header = fn + rideFormat.EXTENSION, rideFormat.header(kind)
+    else:
+        fn, header = fn + '.csv', IMU_HEADER if kind == rideFormat.KIND_IMU else GPS_HEADER
+    return rideWriter.rideWriter(fn, header, WRITER_ROWS, WRITER_DELAY, WRITER_FSYNC)
+
+# Formats an imu sample as a row of the imu .csv
+#
+# @sample: imu sample to format
+def formatImuSample(sample):
+    return f'{ANCHOR.toDatetime(sample["time"])},{sample["accelX"]},{sample["accelY"]},{sample["accelZ"]},'\
+           f'{sample["gyroX"]},{sample["gyroY"]},{sample["gyroZ"]},{sample["didRoll"]},{sample["rollover"]}\n'
+
+# Replaces the contents of the file behind writer with an array of IMU samples
+# The whole window is formatted at once and written in a single block
+#
+# @writer: rideWriter for the file to output to
+# @array: cyclicalArray of samples to write
+def writeImuArray(writer, array):
+    writeImuWindow(writer, array.window())
+
+# Replaces the contents of the file behind writer with a structured array of IMU samples
+#
+# @writer: rideWriter for the file to output to
+# @window: structured array of samples (ringBuffer.IMU_DTYPE)
+def writeImuWindow(writer, window):
+    if writer.binary:
+        writer.rewrite(rideFormat.packAnchor(rideFormat.KIND_IMU, ANCHOR.offset, ANCHOR.fromGps)
+                       + rideFormat.packImuWindow(window))
+        writer.anchor = ANCHOR.offset
+    else:
+        writer.rewrite(ringBuffer.windowToCsv(ringBuffer.utcWindow(window, ANCHOR.offset)))
+
+# Writes an anchor record to a binary ride file before its first row and after the
+# anchor is corrected, readers convert every time in the file with its last anchor
 #
-# @fn: file path to output to
-# @array: data to write
-def writeImuArray(fn, array):
-    # Append every sample in array to .csv
-    with open(fn, "w") as outFile:
-        outFile.write('time,accelX,accelY,accelZ,gyroX,gyroY,gyroZ,possibleRoll,rollover\n')
-        for sample in array:
-            outFile.write(f'{sample["time"]},{sample["accelX"]},{sample["accelY"]},{sample["accelZ"]},'\
-                            f'{sample["gyroX"]},{sample["gyroY"]},{sample["gyroZ"]},{sample["didRoll"]},{sample["rollover"]}\n')
+# @writer: rideWriter for a binary file
+# @kind: rideFormat.KIND_IMU or rideFormat.KIND_GPS
+def writeAnchor(writer, kind):
+    if writer.anchor != ANCHOR.offset:
+        writer.write(rideFormat.packAnchor(kind, ANCHOR.offset, ANCHOR.fromGps))
+        writer.anchor = ANCHOR.offset
 
-# Writes a single imu sample to a file specified by fn
+# Writes a single imu sample through writer
 #
-# @fn: file path to output to
+# @writer: rideWriter for the file to output to
 # @sample: imu sample to write
-def writeImuSample(fn, sample):
-    # Create .csv if it doesn't exist
-    if(not (os.path.exists(fn))):
-        with open(fn, 'a') as outFile:
-            outFile.write('time,accelX,accelY,accelZ,gyroX,gyroY,gyroZ,possibleRoll,rollover\n')
-
-    # Append every sample in array to .csv
-    with open(fn, "a") as outFile:
-        outFile.write(f'{sample["time"]},{sample["accelX"]},{sample["accelY"]},{sample["accelZ"]},'\
-                    f'{sample["gyroX"]},{sample["gyroY"]},{sample["gyroZ"]},{sample["didRoll"]},{sample["rollover"]}\n')
-        
+def writeImuSample(writer, sample):
+    if writer.binary:
+        writeAnchor(writer, rideFormat.KIND_IMU)
+        writer.write(rideFormat.packImu(sample))
+    else:
+        writer.write(formatImuSample(sample))
+
+# Returns True if line is a complete NMEA sentence with a valid checksum
+#
+# @line: bytes read from the GPS UART
+def nmeaValid(line):
+    line = line.strip()
+    if not line.startswith(b'$') or len(line) < 4 or line[-3:-2] != b'*':
+        return False
+    checksum = 0
+    for c in line[1:-3]:
+        checksum ^= c
+    try:
+        return checksum == int(line[-2:], 16)
+    except ValueError:
+        return False
+
+# Checks if the GPS is talking at baud by looking for a valid NMEA sentence
+#
+# @uart: serial port the GPS is connected to
+# @baud: baud rate to try
+#
+# Returns True if a valid sentence was read within GPS_PROBE_SECS
+def probeBaud(uart, baud):
+    uart.baudrate = baud
+    uart.reset_input_buffer()
+    deadline = time.monotonic() + GPS_PROBE_SECS
+    timeout, uart.timeout = uart.timeout, GPS_PROBE_SECS
+    try:
+        while time.monotonic() < deadline:
+            if nmeaValid(uart.readline()):
+                return True
+        return False
+    finally:
+        uart.timeout = timeout
+
+# Works out which sentences the GPS should send and the link speed needed for fixRate
+# At high fix rates GGA (satellites, altitude) is only sent about once a second,
+# RMC (position, speed) is sent with every fix
+#
+# @fixRate: fixes per second
+#
+# Returns a tuple of (fixes per GGA sentence, bits per second the sentences need)
+def gpsSentencePlan(fixRate):
+    ggaEvery = max(1, min(5, int(round(fixRate))))
+    bytesPerSec = fixRate * (RMC_BYTES + GGA_BYTES / ggaEvery)
+    return ggaEvery, bytesPerSec * BITS_PER_BYTE
+
+# Returns the slowest supported baud rate that carries bitsPerSec with GPS_BAUD_MARGIN to spare
+def chooseBaud(bitsPerSec):
+    for baud in GPS_BAUDS:
+        if baud >= bitsPerSec * GPS_BAUD_MARGIN:
+            return baud
+    return GPS_BAUDS[-1]
+
 # Creates a gps instance by setting up UART and creating a GPS object
+# The fix rate is GPS_FIX_RATE if configured, otherwise one fix per sample (at least 1hz,
+# at most GPS_MAX_FIX_RATE), and the baud rate is raised (PMTK251) to carry it
+# If the GPS doesn't answer at the higher baud rate it is told to go back to 9600 baud
+# (in case it switched unheard) and the fastest fix rate 9600 baud can carry is used
+#
+# @sampleRate: number of seconds between GPS samples
 #
 # Returns a GPS object
-def createGps():
-    uart = serial.Serial("/dev/ttyS0", baudrate=9600, timeout=10)
+def createGps(sampleRate=15):
+    import serial
+    import adafruit_gps
+
+    fixRate = GPS_FIX_RATE if GPS_FIX_RATE > 0 else min(GPS_MAX_FIX_RATE, max(1.0, 1.0 / sampleRate))
+    ggaEvery, bitsPerSec = gpsSentencePlan(fixRate)
+    baud = chooseBaud(bitsPerSec)
+
+    uart = serial.Serial("/dev/ttyS0", baudrate=GPS_DEFAULT_BAUD, timeout=10)
     gps = adafruit_gps.GPS(uart, debug=False)
-    # Turn on the basic GGA and RMC info
-    gps.send_command(b'PMTK314,0,1,0,1,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0')
-    # Set update rate to once a second (1hz)
-    gps.send_command(b'PMTK220,1000')
+
+    # The GPS keeps its baud rate while it has power, it may already be at baud
+    if baud != GPS_DEFAULT_BAUD and not probeBaud(uart, baud):
+        probeBaud(uart, GPS_DEFAULT_BAUD)
+        gps.send_command(b'PMTK251,' + str(baud).encode())
+        time.sleep(GPS_SWITCH_DELAY)
+        if not probeBaud(uart, baud):
+            # The GPS may have switched but not been heard, tell it to go back to the
+            # default at the higher baud (the UART is still at baud after the probe)
+            gps.send_command(b'PMTK251,' + str(GPS_DEFAULT_BAUD).encode())
+            time.sleep(GPS_SWITCH_DELAY)
+            # If it still only answers at baud the switch worked after all
+            if probeBaud(uart, GPS_DEFAULT_BAUD) or not probeBaud(uart, baud):
+                # Negotiation failed, stay at the default and only ask for what it can carry
+                with open(ERR_LOG, "a") as errorLog:
+                    errorLog.write(str(datetime.datetime.now())+"\n")
+                    errorLog.write(f"GPS didn't answer at {baud} baud, falling back to {GPS_DEFAULT_BAUD} baud\n")
+                baud = GPS_DEFAULT_BAUD
+                uart.baudrate = baud
+                while fixRate > 1 and chooseBaud(gpsSentencePlan(fixRate)[1]) > baud:
+                    fixRate -= 1
+                ggaEvery, bitsPerSec = gpsSentencePlan(fixRate)
+
+    # Turn on RMC for every fix and GGA every ggaEvery fixes
+    gps.send_command(b'PMTK314,0,1,0,' + str(ggaEvery).encode() + b',0,0,0,0,0,0,0,0,0,0,0,0,0,0,0')
+    # Set update rate
+    gps.send_command(b'PMTK220,' + str(int(1000 / fixRate)).encode())
+
+    with open(ERR_LOG, "a") as errorLog:
+        errorLog.write(str(datetime.datetime.now())+"\n")
+        errorLog.write(f"GPS at {baud} baud, {fixRate} fixes/s, GGA every {ggaEvery} fixes ({int(bitsPerSec)} bits/s)\n")
+    diag.info('GPS at {} baud, {} fixes/s', baud, fixRate)
     return gps
 
-# Samples the GPS
+# Checks the ride's time anchor against the GPS time of a fix, the first fix of a
+# ride with a date re-anchors the ride to GPS time if the system clock is off
 #
-# @gps: GPS object to be sampled
+# @fix: gpsReader.gpsFix
+def correctAnchor(fix):
+    if ANCHOR.fromGps or fix.utc is None or fix.utc.tm_year < 2000:
+        return
+    try:
+        utc = datetime.datetime(*fix.utc[:6])
+    except ValueError:
+        return
+    moved = ANCHOR.correct(utc, int(fix.rxTime * clock.NS), GPS_TIME_TOLERANCE)
+    if moved:
+        diag.warn('System clock off by {:.1f}s, ride times anchored to GPS time', moved)
+        with open(ERR_LOG, "a") as errorLog:
+            errorLog.write(str(datetime.datetime.now())+"\n")
+            errorLog.write(f"System clock off by {moved:.1f}s, ride times anchored to GPS time\n")
+
+# Samples the GPS by reading the latest fix published by its gpsReader thread
+#
+# @reader: gpsReader draining the GPS to be sampled
 #
 # Returns a dictionary containing GPS parameters or None if there is no signal
+# (or the last sentence is older than GPS_STALE seconds)
 # time, latitude, longitude, speed, altitude, and satellites
-def sampleGps(gps):
+def sampleGps(reader):
     lat, long, speedKph, sats, alt = 0,0,0,0,0
-    gps.update()
+    fix = reader.latest()
 
-    if not gps.has_fix:
+    if fix is None or not fix.hasFix or CLOCK.monotonic() - fix.rxTime > GPS_STALE:
         # Try again if we don't have a fix yet.
-        print('Waiting for fix...')
+        diag.info('Waiting for fix...')
         return None
+    correctAnchor(fix)
 
-    print('='*40)
-    if gps.latitude is not None:
-        print('Latitude: {0:.6f} degrees'.format(gps.latitude))
-        lat = gps.latitude
-    if gps.longitude is not None:
-        print('Longitude: {0:.6f} degrees'.format(gps.longitude))
-        long = gps.longitude
-    if gps.satellites is not None:
-        print('# satellites: {}'.format(gps.satellites))
-        sats = gps.satellites
-    if gps.altitude_m is not None:
-        print('Altitude: {} meters'.format(gps.altitude_m))
-        alt = gps.altitude_m
-    if gps.speed_knots is not None:
-        speedKph = gps.speed_knots * CONV
-        print('Speed: {} kph'.format(round(speedKph,5)))
+    if fix.latitude is not None:
+        lat = fix.latitude
+    if fix.longitude is not None:
+        long = fix.longitude
+    if fix.satellites is not None:
+        sats = fix.satellites
+    if fix.altitude is not None:
+        alt = fix.altitude
+    if fix.speedKnots is not None:
+        speedKph = fix.speedKnots * CONV
+
+    diag.debug('{}\nLatitude: {:.6f} degrees\nLongitude: {:.6f} degrees\n# satellites: {}\nAltitude: {} meters\nSpeed: {} kph',
+               '='*40, lat, long, sats, alt, round(speedKph,5))
 
     sample = {
-        'time': datetime.datetime.now(),
+        'time': CLOCK.monotonicNs(),
         'lat': round(lat,5),
         'long': round(long,5),
         'speed': round(speedKph,5),
@@ -256,91 +674,77 @@ def sampleGps(gps):
     return sample
 
 
-# Writes both GPS and corresponding IMU data to the file fn
-#
-# @gpsSample: GPS data to send to fn
-# @imuSample: IMU data to send to fn
-def writeGpsSamples(gpsSample, imuSample, fn):
-        # Create .csv if one does not exist
-    if(not (os.path.exists(fn))):
-        with open(fn, 'a') as outFile:
-            outFile.write('time,lat,long,vel,alt,sats,accelX,accelY,accelZ,possibleRoll,rollover\n')
-
-    # Write content to file
-    if gpsSample and imuSample:
-        with open(fn, "a") as outFile:
-            outFile.write(f'{gpsSample["time"]},' \
-                            f'{gpsSample["lat"]},' \
-                            f'{gpsSample["long"]},' \
-                            f'{gpsSample["speed"]},' \
-                            f'{gpsSample["alt"]},' \
-                            f'{gpsSample["sats"]},' \
-                            f'{imuSample["accelX"]},' \
-                            f'{imuSample["accelY"]},' \
-                            f'{imuSample["accelZ"]},' \
-                            f'{imuSample["didRoll"]},' \
-                            f'{imuSample["rollover"]}\n')
+# Writes both GPS and corresponding IMU data through writer
+#
+# @gpsSample: GPS data to write
+# @imuSample: IMU data to write
+# @writer: rideWriter for the GPS file
+def writeGpsSamples(gpsSample, imuSample, writer):
+    if writer.binary:
+        writeAnchor(writer, rideFormat.KIND_GPS)
+        # No fix is written as a tagged record rather than a row of nulls
+        writer.write(rideFormat.packGps(gpsSample, imuSample))
+    elif gpsSample and imuSample:
+        writer.write(f'{ANCHOR.toDatetime(gpsSample["time"])},' \
+                     f'{gpsSample["lat"]},' \
+                     f'{gpsSample["long"]},' \
+                     f'{gpsSample["speed"]},' \
+                     f'{gpsSample["alt"]},' \
+                     f'{gpsSample["sats"]},' \
+                     f'{imuSample["accelX"]},' \
+                     f'{imuSample["accelY"]},' \
+                     f'{imuSample["accelZ"]},' \
+                     f'{imuSample["didRoll"]},' \
+                     f'{imuSample["rollover"]}\n')
     else:
-        with open(fn, "a") as outFile:
-            outFile.write(f'null,' \
-                            f'null,' \
-                            f'null,' \
-                            f'null,' \
-                            f'null,' \
-                            f'null,' \
-                            f'null,' \
-                            f'null,' \
-                            f'null,' \
-                            f'null,' \
-                            f'null\n')
+        writer.write(','.join(['null']*11) + '\n')
+
+# Returns the shared satellite transmitter, starting it (and opening the RockBLOCK) on first use
+# It outlives sampling restarts so queued messages aren't lost and the modem stays configured
+def getTransmitter():
+    global transmitter
+    with transmitterLock:
+        if transmitter is None:
+            transmitter = satTransmitter.satTransmitter(rbSession.rbSession(RB_PORT), RB_RETRY)
+            transmitter.start()
+    return transmitter
 
 # Inherited class of rockBlockProtocol for sending outbound messages
-# Has a send method that takes a message 'msg' to transmit via rockblock
+# Has a send method that queues content on the satellite transmitter (of BACKEND) and returns immediately
 # The other three methods are event handlers for starting an attempt,
-# failing an attempt, and succedding an attempt
+# failing an attempt, and succedding an attempt, called from the transmitter thread
 class moMessage (rockBlock.rockBlockProtocol):
     content = ""
 
     def send(self):
-        try:
-            rb = rockBlock.rockBlock("/dev/ttyUSB0", self)
-            rb.sendMessage(self.content)
-            rb.close()
-        except Exception as exc:
-            with open(ERR_LOG, "a") as errorLog:
-                errorLog.write(str(datetime.datetime.now())+"\n")
-                traceback.print_tb(exc.__traceback__, file=errorLog)
+        BACKEND.sendMessage(self.content, self)
 
     def rockBlockTxStarted(self):
-        print("rockBlockTxStarted")
+        diag.info("rockBlockTxStarted")
 
     def rockBlockTxFailed(self):
-        print ("rockBlockTxFailed")
-        self.send()
+        diag.warn("rockBlockTxFailed")
 
     def rockBlockTxSuccess(self,momsn):
-        print ("rockBlockTxSuccess " + str(momsn))
+        diag.info("rockBlockTxSuccess {}", momsn)
+
+# Returns the shared in-memory store of ride history counters
+def getRideCounter():
+    return rideCounter.getStore(HISTORY, HISTORY_FLUSH)
 
-# Read the ride history json and convert it to a dict
+# Read the ride history counters as a dict
 #
 # Returns a dictionary with the last ride index (int) and sent rides list
 def getRideHistory():
-    with open(HISTORY) as rideHistoryJson:
-        rideHistory = json.load(rideHistoryJson)
+    return getRideCounter().snapshot()
 
-    return rideHistory
-
-# Update the ride history json with new info for all of it's parameters
+# Update one of the ride history counters, the json is only rewritten
+# when the value changes and at most once every HISTORY_FLUSH seconds
 #
-# @rideHistory: a dict representing the parameters to be written to the ride history json
-
+# @index: new value of the counter
+# @item: name of the counter to update
 def updateRideHistory(index, item):
-    rideHistory = getRideHistory()
-
-    rideHistory[item] = index
-        
-    with open(HISTORY, "w") as rideHistoryJson:
-        rideHistoryJson.write(json.dumps(rideHistory))
+    getRideCounter().set(item, index)
 
 # Processes IMU data depending on which mode is selected
 # NOTE: This function exists as a helper for startSampling
@@ -348,18 +752,23 @@ def updateRideHistory(index, item):
 # @mode: device mode
 # @index: current ride's index
 # @imuData: dictionary containing imu data to process
-# @imuCompleteFilename: filename for research logs
+# @imuCompleteWriter: rideWriter for research logs
 # @rollCount: rollover counter
 # @recentImuSamples: circular array of IMU samples
+# @stats: loopStats the time of each step is recorded in
 #
 # Returns an updated Rollcount
-def logImu(mode, index, imuData, imuCompleteFilename, rollCount, recentImuSamples):
+def logImu(mode, index, imuData, imuCompleteWriter, rollCount, recentImuSamples, stats):
+    start = stats.timer()
     if mode == 1:
-        writeImuSample(imuCompleteFilename, imuData)
+        writeImuSample(imuCompleteWriter, imuData)
+        start = stats.lap("imuWrite", start)
         updateRideHistory(index, "lastResearchRide")
+        stats.lap("historyUpdate", start)
     else:
         rollCount = updateRollCount(rollCount, imuData)
         recentImuSamples.append(imuData)
+        stats.lap("rollCount", start)
         
     return rollCount
 
@@ -369,28 +778,63 @@ def logImu(mode, index, imuData, imuCompleteFilename, rollCount, recentImuSample
 # @index: current ride's index
 # @gpsData: dictionary containing GPS data
 # @imuData: dictionary containing imu data
-# @filename: filename for GPS data log
-def logGps(index, gpsData, imuData, filename):
+# @gpsWriter: rideWriter for GPS data log
+# @stats: loopStats the time of each step is recorded in
+def logGps(index, gpsData, imuData, gpsWriter, stats):
     try:         
         if gpsData and imuData:
-            print('*'*16 + ' writing ' + '*'*15)
-            writeGpsSamples(gpsData, imuData, filename)
-            updateRideHistory(index, "lastRide")          
+            diag.debug('{} writing {}', '*'*16, '*'*15)
+            start = stats.timer()
+            writeGpsSamples(gpsData, imuData, gpsWriter)
+            start = stats.lap("gpsWrite", start)
+            updateRideHistory(index, "lastRide")
+            stats.lap("historyUpdate", start)
     except Exception as exc:
         with open(ERR_LOG, "a") as errorLog:
             errorLog.write(str(datetime.datetime.now())+"\n")
             traceback.print_tb(exc.__traceback__, file=errorLog)
         
+# Logs an exception that stopped sampling
+def logSamplingFailure(exc, attempt, delay):
+    if delay is None:
+        return
+    with open(ERR_LOG, "a") as errorLog:
+        errorLog.write(str(datetime.datetime.now())+"\n")
+        errorLog.write(f"Sampling stopped (restart {attempt}), restarting in {delay:.1f} seconds.\n")
+        traceback.print_tb(exc.__traceback__, file=errorLog)
+    diag.error("Sampling stopped: {}, restarting in {:.1f} seconds", exc, delay)
+
 # Samples the GPS and IMU every second, outputs to a csv every sampleRate seconds
+# Sampling is restarted (see SAMPLING_RETRY) whenever a sensor or file error stops it
 #
 # @fn: a string that is the desired output filename
-# @sampleRate: a double that represents the number of seconds until a sample is writen to fn
+# @gpsSampleRate: number of seconds between GPS samples written to fn
+# @imuSampleRate: number of seconds between IMU samples
+# @mode: device mode (0 = Farm, 1 = Research)
 def startSampling(fn, gpsSampleRate, imuSampleRate, mode):
-    lastGpsWrite = 0.0
-    lastImuWrite = 0.0
+    try:
+        SAMPLING_RETRY.call(sampleRide, fn, gpsSampleRate, imuSampleRate, mode, onFailure=logSamplingFailure)
+    except samplingStopped:
+        diag.info("Sampling stopped, no more sensor data")
+
+# Runs one sampling session of startSampling until an exception stops it
+# The main loop is a taskScheduler that sleeps until the next task is due,
+# the keyfob is watched with an interrupt rather than polled
+# Sensors, keyfob, clock and RockBLOCK come from BACKEND
+# Sensor threads are stopped and writers closed before the exception is raised
+#
+# @fn: a string that is the desired output filename
+# @gpsSampleRate: number of seconds between GPS samples written to fn
+# @imuSampleRate: number of seconds between IMU samples
+# @mode: device mode (0 = Farm, 1 = Research)
+def sampleRide(fn, gpsSampleRate, imuSampleRate, mode):
     rollCount = 0
-    gps, imu = None, None
-    recentImuSamples = cyclicalArray(IMU_SAMPLE_SIZE)
+    gps, imu, imuThread, gpsThread = None, None, None, None
+    gpsData, imuData = None, None
+    recentImuSamples = ringBuffer.cyclicalArray(IMU_SAMPLE_SIZE)
+    tasks = scheduler.taskScheduler(SCHED_POLICY, SCHED_CATCH_UP, CLOCK)
+    # Timing histograms of the loop's threads, dumped to the ride's stats file
+    stats = loopStats.loopStats(CLOCK)
     
     # Get index for this ride
     rideHistory = getRideHistory()
@@ -399,68 +843,184 @@ def startSampling(fn, gpsSampleRate, imuSampleRate, mode):
     else:
         index = rideHistory["lastResearchRide"] + 1
     
-    # Setup GPIO channel for keyfob
-    GPIO.setup(FOB_GPIO, GPIO.IN, pull_up_down=GPIO.PUD_DOWN)
+    # Watch the keyfob, a press makes the alert task due immediately
+    BACKEND.watchKeyfob(lambda: tasks.trigger("alert"))
     
-    # Create rockblock message instance
+    # Create rockblock message instance, alerts are sent from the satellite transmitter thread
     outMessage = moMessage()
+    BACKEND.start()
     
+    # Setup file I/O, files (and their headers) are created on first write
+    gpsWriter = createWriter(PATH + fn, rideFormat.KIND_GPS)
+    imuWriter = createWriter(PATH + fn + '_imu', rideFormat.KIND_IMU)
+    imuCompleteWriter = createWriter(IMU_FULL_REC_PATH + 'ride' + str(index) + '_imuComplete', rideFormat.KIND_IMU)
+    statsFn = STATS_PATH + 'ride' + str(index) + '_loopStats.jsonl'
+
+    # Write a frozen crash capture window to its own file, runs on a thread of its own
+    def saveCapture(window):
+        captureFn = CAPTURE_PATH + 'ride' + str(index) + '_capture' + \
+                    ANCHOR.toDatetime(CLOCK.monotonicNs()).strftime('%Y%m%d%H%M%S')
+        try:
+            writer = createWriter(captureFn, rideFormat.KIND_IMU)
+            writeImuWindow(writer, window)
+            writer.close()
+            diag.info('Crash capture of {} samples saved to {}', len(window), writer.fn)
+        except Exception as exc:
+            with open(ERR_LOG, "a") as errorLog:
+                errorLog.write(str(datetime.datetime.now())+"\n")
+                errorLog.write(f"Unable to save crash capture {captureFn}\n")
+                traceback.print_tb(exc.__traceback__, file=errorLog)
+
+    # High rate IMU ring frozen around a rollover or keyfob press, once per event
+    # captured is cleared once the vehicle is upright again so repeated alerts of the
+    # same rollover don't save overlapping captures
+    capture = None
+    captured = False
+    if CAPTURE_RATE > 0:
+        capture = crashCapture.crashCapture(CAPTURE_RATE, CAPTURE_PRE, CAPTURE_POST, saveCapture)
+
+    # Process every IMU sample taken since the last run
+    def imuTask():
+        nonlocal rollCount, imuData, captured
+        if imuThread.error is not None:
+            raise imuThread.error
+        stats.interval("imuTask", imuSampleRate, stats.now())
+        start = stats.timer()
+        samples = imuThread.drain()
+        # With an orientation filter the sampler has already set didRoll
+        if imuThread.orientation is None:
+            classifyImuSamples(samples)
+        stats.lap("rolloverCheck", start)
+        # Checked after every sample, rollCount can pass CRASHTHRESH within one drained batch
+        for imuData in samples:
+            rollCount = logImu(mode, index, imuData, imuCompleteWriter, rollCount, recentImuSamples, stats)
+            diag.debug('Rollcount: {}', rollCount)
+            if rollCount == 0 and not imuThread.rolledOver:
+                captured = False
+            # A rollover the orientation filter has already alerted on isn't sent again
+            if (mode == 0) and (rollCount == CRASHTHRESH) and not imuThread.rolledOver:
+                alertTask()
+
+    # Sample GPS and write data to file along with the latest IMU sample
+    def gpsTask():
+        nonlocal gpsData, imuData
+        stats.interval("gpsTask", gpsSampleRate, stats.now())
+        start = stats.timer()
+        gpsData = sampleGps(gpsThread)
+        stats.lap("gpsSample", start)
+        diag.debug('GPS fix rate: {:.1f} fixes/s', gpsThread.fixRate())
+        imuData = imuThread.latest
+        if imuData is not None and imuThread.orientation is None:
+            imuData['didRoll'] = detectRollover(imuData)
+        logGps(index, gpsData, imuData, gpsWriter, stats)
+
+    # Push out rows and counters that have been held in memory too long
+    def flushTask():
+        start = stats.timer()
+        gpsWriter.tick()
+        imuCompleteWriter.tick()
+        start = stats.lap("fileFlush", start)
+        getRideCounter().flush(force=False)
+        stats.lap("historyFlush", start)
+
+    # Append a snapshot of the timing histograms (and the counters behind missing samples) to the stats file
+    def statsTask():
+        try:
+            stats.dump(statsFn, {
+                "imuDropped": imuThread.dropped if imuThread is not None else 0,
+                "gpsErrors": gpsThread.errors if gpsThread is not None else 0,
+                "overruns": {t.name: t.overruns for t in tasks.tasks}
+            })
+        except Exception as exc:
+            with open(ERR_LOG, "a") as errorLog:
+                errorLog.write(str(datetime.datetime.now())+"\n")
+                errorLog.write(f"Unable to write loop stats {statsFn}\n")
+                traceback.print_tb(exc.__traceback__, file=errorLog)
+
+    # Assess rollover scenario, runs on a rollover or when the keyfob is pressed
+    def alertTask():
+        nonlocal captured
+        if capture is not None and not captured:
+            capture.trigger()
+            captured = True
+        if mode != 0:
+            return
+        # Rollover Scenario
+        diag.error('{} Rollover! {}', '*'*15, '*'*15)
+        with open(ERR_LOG, "a") as errorLog:
+            errorLog.write(str(datetime.datetime.now())+"\nLogging Rollover\n")
+        # Update most recent IMU sample to rollover status
+        recentImuSamples.setEnd("rollover", True)
+        writeImuArray(imuWriter, recentImuSamples)
+        if gpsData and imuData:
+            writeGpsSamples(gpsData, imuData, gpsWriter)
+            gpsWriter.flush()
+            # Update rideHistory.json with new ride index due to file write
+            updateRideHistory(index, "lastRide")
+            getRideCounter().flush()
+            # Send emergency message
+            emergencyMsg = f"{PHONE},{gpsData['long']},{gpsData['lat']},{DEV_ID}"
+        else:
+            # No gps connection at time of crash
+            emergencyMsg = f"{PHONE},,,{DEV_ID}"
+        if SBD_FORMAT == "bin":
+            gpsFix = None
+            if gpsData:
+                gpsFix = dict(gpsData, time=ANCHOR.toDatetime(gpsData['time']).replace(tzinfo=datetime.timezone.utc))
+            emergencyMsg = sbdMessage.encode(PHONE, DEV_ID, gpsFix, rollCount >= CRASHTHRESH or imuThread.rolledOver,
+                                             recentImuSamples.window(), ANCHOR.toUnix(CLOCK.monotonicNs()))
+        outMessage.content = emergencyMsg
+        with open(ERR_LOG, "a") as errorLog:
+            errorLog.write(str(datetime.datetime.now())+"\n")
+            errorLog.write(f"Attempting to send {emergencyMsg.hex() if SBD_FORMAT == 'bin' else 'string: ' + emergencyMsg} to Rock7!\n")
+        outMessage.send()
+
     # Create sensor instances
     try:
-        gps = createGps()
-        imu = createImu()
-
-        # Setup file I/O, and create Header for .csv
-        filename = PATH + fn + '.csv'
-        imuFilename = PATH + fn + '_imu.csv'
-        imuCompleteFilename = IMU_FULL_REC_PATH + 'ride' + str(index) + '_imuComplete.csv'
-
-        # Main loop
-        while True:
-            # Check if mode is Farm (0) or Research (1)
-            currentTime = time.monotonic()
-            if currentTime - lastImuWrite >= imuSampleRate:
-                imuData = sampleImu(imu)
-                rollCount = logImu(mode, index, imuData, imuCompleteFilename, rollCount, recentImuSamples)
-                print(f'Rollcount: {rollCount}')
-                
-                lastImuWrite = currentTime
-          
-            # Sample GPS and write data to file
-            currentTime = time.monotonic()
-            if currentTime - lastGpsWrite >= gpsSampleRate:
-                gpsData = sampleGps(gps)
-                imuData = sampleImu(imu)
-                logGps(index, gpsData, imuData, filename)
-                
-                lastGpsWrite = currentTime
-                            
-            # Assess rollover scenario
-            if ((mode == 0) and (rollCount == CRASHTHRESH)) or ((mode == 0) and (GPIO.input(FOB_GPIO))):
-                # Rollover Scenario
-                print('*'*15 + ' Rollover! ' + '*'*15)
-                with open(ERR_LOG, "a") as errorLog:
-                    errorLog.write(str(datetime.datetime.now())+"\nLogging Rollover\n")
-                # Update most recent IMU sample to rollover status
-                recentImuSamples.getEnd()["rollover"] = True
-                writeImuArray(imuFilename, recentImuSamples)
-                if gpsData and imuData:
-                    writeGpsSamples(gpsData, imuData, filename)
-                    # Update rideHistory.json with new ride index due to file write
-                    updateRideHistory(index, "lastRide")
-                    # Send emergency message
-                    emergencyMsg = f"{PHONE},{gpsData['long']},{gpsData['lat']},{DEV_ID}"
-                else:
-                    # No gps connection at time of crash
-                    emergencyMsg = f"{PHONE},,,{DEV_ID}"
-                outMessage.content = emergencyMsg
-                with open(ERR_LOG, "a") as errorLog:
-                    errorLog.write(str(datetime.datetime.now())+"\n")
-                    errorLog.write(f"Attempting to send string: {emergencyMsg} to Rock7!\n")
-                outMessage.send()
+        gps = BACKEND.createGps(gpsSampleRate)
+        imu = BACKEND.createImu()
+
+        # Drain the GPS UART on its own thread, GPS samples read its latest fix
+        gpsThread = gpsReader.gpsReader(gps, CLOCK, stats)
+        gpsThread.start()
+
+        # Sample the IMU on its own thread so a slow GPS read can't delay it
+        # With an orientation filter a rollover held for ROLLOVER_HOLD seconds raises the alert
+        # straight away, rather than after crashTimerThreshold IMU samples
+        estimator = orientation.orientationFilter(ORIENTATION_TAU) if ORIENTATION_RATE > 0 else None
+        imuThread = imuSampler(imu, imuSampleRate, capture=capture, stats=stats, orientation=estimator,
+                               onRollover=lambda: tasks.trigger("alert"))
+        imuThread.start()
+
+        # Main loop, the IMU task runs half a period after the sampler so its sample is queued
+        tasks.add("imu", imuSampleRate, imuTask, phase=imuSampleRate / 2)
+        tasks.add("gps", gpsSampleRate, gpsTask)
+        tasks.add("flush", WRITER_DELAY, flushTask, phase=WRITER_DELAY)
+        tasks.add("alert", None, alertTask)
+        if LOOP_STATS_SECS > 0:
+            tasks.add("stats", LOOP_STATS_SECS, statsTask, phase=LOOP_STATS_SECS)
+        tasks.run()
                 
-    except Exception as exc:
-        with open(ERR_LOG, "a") as errorLog:
-            errorLog.write(str(datetime.datetime.now())+"\n")
-            traceback.print_tb(exc.__traceback__, file=errorLog)
-        startSampling(fn, gpsSampleRate, imuSampleRate, mode)
+    finally:
+        tasks.stop()
+        BACKEND.unwatchKeyfob()
+        if imuThread is not None:
+            imuThread.stop()
+            imuThread.join()
+        if capture is not None:
+            capture.join()
+        if gpsThread is not None:
+            gpsThread.stop()
+            gpsThread.join()
+        if LOOP_STATS_SECS > 0:
+            statsTask()
+        # Write out anything still held in memory before stopping
+        for writer in (gpsWriter, imuWriter, imuCompleteWriter):
+            try:
+                writer.close()
+            except Exception:
+                pass
+        try:
+            getRideCounter().flush()
+        except Exception:
+            pass
@@ -0,0 +1,12 @@
+#!/usr/bin/python3
+
+# Reads an optional element from the config, for parameters older about.xml files may not have
+#
+# @config: parsed config document
+# @tag: name of the element
+# @default: value returned if the element is missing or empty, also sets the type of the value
+def configValue(config, tag, default):
+    elements = config.getElementsByTagName(tag)
+    if elements and elements[0].firstChild is not None:
+        return type(default)(elements[0].firstChild.data.strip())
+    return default
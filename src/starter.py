@@ -1,7 +1,6 @@
 #!/usr/bin/python3
 import os
 import os.path
-import json
 import shutil
 import sensors
 import datetime
@@ -10,7 +9,6 @@ import db
 from xml.dom import minidom
 from xml.dom.minidom import parse, Text
 
-HISTORY = "/home/pi/kadd-pi/data/rideHistory.json"
 CURRENT_RIDES = "/home/pi/kadd-pi/data/rides/current/"
 UNSENT_RIDES = "/home/pi/kadd-pi/data/rides/unsent/"
 SENT_RIDES = "/home/pi/kadd-pi/data/rides/sent/"
@@ -101,21 +99,11 @@ def prepFiles():
             errorLog.write(str(datetime.datetime.now())+"\n")
             traceback.print_tb(exc.__traceback__, file=errorLog)
 
-# Read the ride history json and convert it to a dict
+# Read the ride history counters as a dict, shares the store used by sensors
 #
 # Returns a dictionary with the last ride index (int) and sent rides list
 def getRideHistory():
-    with open(HISTORY) as rideHistoryJson:
-        rideHistory = json.load(rideHistoryJson)
-
-    return rideHistory
-
-# Update the ride history json with new info for all of it's parameters
-#
-# @rideHistory: a dict representing the parameters to be written to the ride history json
-def setRideHistory(rideHistory):
-    with open(HISTORY, "w") as rideHistoryJson:
-        rideHistoryJson.write(json.dumps(rideHistory))
+    return sensors.getRideHistory()
 
 # Determine the current ride's name by reading the ride history json
 # and incrementing the "lastRide" value
@@ -157,22 +145,25 @@ def main():
             errorLog.write(str(datetime.datetime.now())+f"\nStarting data transmission thread\n")
             
         print("Attempting to send data!")
-        # Get list of files in unsent rides dir
-        unsentRides = os.listdir(UNSENT_RIDES)
+        # Get list of files in unsent rides dir and upload them concurrently
+        unsentRides = [ride for ride in os.listdir(UNSENT_RIDES) if ride != ".gitignore"]
+        results = db.uploadRides([UNSENT_RIDES + ride for ride in unsentRides])
         
         for ride in unsentRides:
-            if ride != ".gitignore":
-                db.sendFileToDb(UNSENT_RIDES + ride)
+            with open(ERR_LOG, "a") as errorLog:
+                errorLog.write(str(datetime.datetime.now())+"\n")
+                errorLog.write(f"Attempt made to file: {UNSENT_RIDES + ride} to database! Committed: {results[UNSENT_RIDES + ride]}\n")
+            if not results[UNSENT_RIDES + ride]:
+                # Leave it in unsent, the next attempt resumes from its last committed page
+                continue
+            try:
+                # attempt to move sent file to sent rides dir
+                shutil.move(UNSENT_RIDES + ride, SENT_RIDES + ride)
+                db.finishUpload(UNSENT_RIDES + ride)
+            except Exception as exc:
                 with open(ERR_LOG, "a") as errorLog:
                     errorLog.write(str(datetime.datetime.now())+"\n")
-                    errorLog.write(f"Attempt made to file: {UNSENT_RIDES + ride} to database!\n")
-                try:
-                    # attempt to move sent file to sent rides dir
-                    shutil.move(UNSENT_RIDES + ride, SENT_RIDES + ride)
-                except Exception as exc:
-                    with open(ERR_LOG, "a") as errorLog:
-                        errorLog.write(str(datetime.datetime.now())+"\n")
-                        traceback.print_tb(exc.__traceback__, file=errorLog)
+                    traceback.print_tb(exc.__traceback__, file=errorLog)
     else:
         # Child thread
         print(f"Starting {currentRide}!")
@@ -0,0 +1,98 @@
+#!/usr/bin/python3
+import os
+import os.path
+import json
+import threading
+
+# Upload states of a ride file
+PENDING = "pending"
+IN_PROGRESS = "in-progress"
+DONE = "done"
+
+# Class tracking the upload of one ride file, saved as <ride file name>.json in a manifest directory
+#
+# Initilization takes the path of the ride file and the manifest directory, an
+# existing manifest is loaded, otherwise the ride starts out PENDING
+# begin records the pages the ride was split into, markCommitted checkpoints pages
+# as their commits are confirmed, and finish marks the whole ride DONE
+# Every change is written out atomically (temp file and rename) before returning,
+# so an interrupted upload resumes from the last committed page
+class uploadManifest:
+    def __init__(self, filename, manifestDir):
+        self.filename = filename
+        self.fn = os.path.join(manifestDir, os.path.basename(filename) + ".json")
+        self.lock = threading.Lock()
+        self.state = PENDING
+        self.size = None
+        self.pageRows = None
+        self.pageCount = None
+        self.committed = set()
+        self.attempts = 0
+
+        if os.path.exists(self.fn):
+            try:
+                with open(self.fn) as manifestJson:
+                    manifest = json.load(manifestJson)
+                self.state = manifest["state"]
+                self.size = manifest["size"]
+                self.pageRows = manifest["pageRows"]
+                self.pageCount = manifest["pageCount"]
+                self.committed = set(manifest["committed"])
+                self.attempts = manifest["attempts"]
+            except (ValueError, KeyError):
+                # Unreadable manifest, upload the ride from scratch
+                pass
+
+    # Starts (or resumes) an upload of pageCount pages of pageRows rows
+    # Committed pages are kept only if the file and page layout are unchanged
+    def begin(self, pageCount, pageRows):
+        with self.lock:
+            size = os.path.getsize(self.filename)
+            if (size, pageRows, pageCount) != (self.size, self.pageRows, self.pageCount):
+                self.committed = set()
+            self.size = size
+            self.pageRows = pageRows
+            self.pageCount = pageCount
+            self.state = IN_PROGRESS
+            self.attempts += 1
+            self._save()
+
+    # Returns True if page was committed by this or an earlier attempt
+    def isCommitted(self, page):
+        return page in self.committed
+
+    # Records that pages have been committed to the database
+    def markCommitted(self, pages):
+        with self.lock:
+            self.committed.update(pages)
+            self._save()
+
+    # Records that every page and the parent document have been committed
+    def finish(self):
+        with self.lock:
+            self.state = DONE
+            self._save()
+
+    def isDone(self):
+        return self.state == DONE
+
+    # Deletes the manifest, once the ride file has been moved to sent
+    def remove(self):
+        if os.path.exists(self.fn):
+            os.remove(self.fn)
+
+    def _save(self):
+        manifest = {
+            "state": self.state,
+            "size": self.size,
+            "pageRows": self.pageRows,
+            "pageCount": self.pageCount,
+            "committed": sorted(self.committed),
+            "attempts": self.attempts
+        }
+        tmp = self.fn + ".tmp"
+        with open(tmp, "w") as manifestJson:
+            manifestJson.write(json.dumps(manifest))
+            manifestJson.flush()
+            os.fsync(manifestJson.fileno())
+        os.replace(tmp, self.fn)